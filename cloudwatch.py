@@ -1,75 +1,266 @@
 import datetime
 import re
+import json
 import os
+import hashlib
 import sys
 from prettytable import PrettyTable
 from botocore.exceptions import EndpointConnectionError
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import common
 
+STATE_FILE = 'state.json'
 
-def list_and_save(logs_client, start_time, stop_time):
+
+def list_and_save(logs_client, start_time, stop_time, workers=8, state=None, output=None):
+    # state holds the watermark {'timestamp': ..., 'token': ..., 'shard': ...} of every stream from the previous
+    # run, it is updated in place with the last collected event of each stream.
+    # output contains the ShardWriter options and 'ndjson' to keep the events with their metadata.
     groups = []
     try:
-        groups = logs_client.describe_log_groups()['logGroups']
+        groups = list(describe(logs_client, 'describe_log_groups', 'logGroups'))
     except EndpointConnectionError as error:
         print('Error: {}'.format(error))
         sys.exit()
     except ClientError as error:
         common.exception(error, 'Describe log groups failed.')
 
+    if state is None:
+        state = {}
     values = []
     filenames = []
+    skipped = 0
 
-    for group in groups:
-        group_name = group['logGroupName']
-        streams = logs_client.describe_log_streams(logGroupName=group_name)['logStreams']
-        for stream in streams:
-            stream_name = stream['logStreamName']
-            values.append(str(group_name))
-
-            log_events = logs_client.get_log_events(logGroupName=group_name, logStreamName=stream_name,
-                                                    startTime=start_time, endTime=stop_time)
-            events = log_events['events']
-
-            groupname = re.sub('[^\w\s-]', '', group_name)
-            streamname = re.sub('[^\w\s-]', '', stream_name)
-            gr_st = groupname + '--' + streamname
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for group in groups:
+            group_name = group['logGroupName']
+            group_state = state.setdefault(group_name, {})
+            try:
+                for stream in describe(logs_client, 'describe_log_streams', 'logStreams', logGroupName=group_name):
+                    stream_name = stream['logStreamName']
+                    values.append(str(group_name))
+                    watermark = group_state.get(stream_name)
+                    if watermark and stream.get('lastEventTimestamp', 0) <= watermark['timestamp']:
+                        skipped += 1
+                        continue
+                    futures.append((group_state, stream_name,
+                                    executor.submit(save_stream, logs_client, group_name, stream_name,
+                                                    start_time, stop_time, watermark, output)))
+            except ClientError as error:
+                print('Describe log streams failed for {}: {}'.format(group_name, error))
 
-            filenames += write_events(events, gr_st)
+        for group_state, stream_name, future in futures:
+            stream_filenames, watermark = future.result()
+            filenames += stream_filenames
+            if watermark:
+                group_state[stream_name] = watermark
 
+    if skipped:
+        print('Skipped {} streams without new events.'.format(skipped))
     print('Files downloaded to $currentpath/cw_logs folder.')
     values = set(values)
 
     return filenames, values
 
 
-def write_events(events, gr_st):
+def filter_and_save(logs_client, start_time, stop_time, filter_pattern, prefixes=None, workers=8, output=None):
+    # Only the events matching filter_pattern are transferred, the filtering is done by CloudWatch.
+    groups = []
+    try:
+        groups = list(describe(logs_client, 'describe_log_groups', 'logGroups'))
+    except EndpointConnectionError as error:
+        print('Error: {}'.format(error))
+        sys.exit()
+    except ClientError as error:
+        common.exception(error, 'Describe log groups failed.')
+
+    # overlapping prefixes would download the same events twice
+    if prefixes:
+        prefixes = [prefix for prefix in set(prefixes)
+                    if not any(prefix != other and prefix.startswith(other) for other in prefixes)]
 
+    values = []
     filenames = []
+    matched = 0
+    matched_bytes = 0
+    matched_streams = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(filter_group, logs_client, group['logGroupName'], start_time, stop_time,
+                                   filter_pattern, prefix, output)
+                   for group in groups for prefix in (prefixes or [None])]
+
+        for future in futures:
+            group_name, result = future.result()
+            if result['streams']:
+                values.append(str(group_name))
+            filenames += result['filenames']
+            matched += result['events']
+            matched_bytes += result['bytes']
+            matched_streams += result['streams']
+
+    print('Matched {} events ({:.1f} MB) in {} streams.'.format(
+        matched, matched_bytes / float(common.MB), matched_streams))
+    print('Files downloaded to $currentpath/cw_logs/filtered folder.')
+
+    return filenames, set(values)
+
+
+def filter_group(logs_client, group_name, start_time, stop_time, filter_pattern, prefix=None, output=None):
+    kwargs = {'logGroupName': group_name, 'filterPattern': filter_pattern, 'startTime': start_time,
+              'endTime': stop_time}
+    if prefix:
+        kwargs['logStreamNamePrefix'] = prefix
+
+    # the filtered events are kept apart from the incremental shards and from the results of other patterns
+    directory = os.path.join(log_directory(), 'filtered')
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    suffix = '-filter-' + hashlib.sha256(filter_pattern.encode('utf-8')).hexdigest()[:8]
+    writers = {}
+    result = {'filenames': [], 'events': 0, 'bytes': 0, 'streams': 0}
+    try:
+        while True:
+            response = common.with_backoff(logs_client.filter_log_events, **kwargs)
+            for event in response['events']:
+                stream_name = event['logStreamName']
+                if stream_name not in writers:
+                    writers[stream_name] = stream_writer(group_name, stream_name, output, directory=directory,
+                                                         suffix=suffix)
+                write_event(writers[stream_name], event, group_name, stream_name)
+                result['events'] += 1
+                result['bytes'] += len(event['message'])
+            if not response.get('nextToken'):
+                break
+            kwargs['nextToken'] = response['nextToken']
+    except ClientError as error:
+        print('Log group is skipped: {}, due to: {}'.format(group_name, error))
+    finally:
+        for writer in writers.values():
+            result['filenames'] += writer.close()
+
+    result['streams'] = len(writers)
+    return group_name, result
 
-    current_directory = os.getcwd()
-    final_directory = os.path.join(current_directory, r'cw_logs')
-    if not os.path.exists(final_directory):
-        os.makedirs(final_directory)
 
-    file_name = ""
+def describe(logs_client, operation, result_key, **kwargs):
+    while True:
+        response = common.with_backoff(getattr(logs_client, operation), **kwargs)
+        for item in response[result_key]:
+            yield item
+        if not response.get('nextToken'):
+            break
+        kwargs['nextToken'] = response['nextToken']
 
+
+def get_events(logs_client, group_name, stream_name, start_time, stop_time, position=None):
+    # position['token'] is where the reading starts and it is updated with the last forward token.
+    if position is None:
+        position = {}
+    kwargs = {'logGroupName': group_name, 'logStreamName': stream_name, 'endTime': stop_time, 'startFromHead': True}
+    # a saved token already marks the position, startTime is only used without it
+    if position.get('token'):
+        kwargs['nextToken'] = position['token']
+    else:
+        kwargs['startTime'] = start_time
+    while True:
+        response = common.with_backoff(logs_client.get_log_events, **kwargs)
+        for event in response['events']:
+            yield event
+        # the end of the stream is reached when the same token is returned again
+        token = response.get('nextForwardToken')
+        if token:
+            position['token'] = token
+        if not token or token == kwargs.get('nextToken'):
+            break
+        kwargs['nextToken'] = token
+
+
+def save_stream(logs_client, group_name, stream_name, start_time, stop_time, watermark=None, output=None):
+    # The events are written as they are received, page by page. The returned watermark covers the
+    # events that were written, also when the download stopped because of an error.
+    position = {}
+    shard = 1
+    if watermark:
+        start_time = max(start_time, watermark['timestamp'] + 1)
+        position['token'] = watermark.get('token')
+        shard = watermark.get('shard', 1)
+
+    writer = stream_writer(group_name, stream_name, output, start=shard, append=bool(watermark))
+    last_timestamp = None
     try:
-        message = ''
-        for event in events:
-            if event['message']:
-                message = message + event['message'] + '\n'
-        if message:
-            file_name = final_directory + '/' + gr_st + '.txt'
-            filenames.append(file_name)
-            with open(file_name, 'w+') as f:
-                f.write(message)
+        with writer:
+            try:
+                events = get_events(logs_client, group_name, stream_name, start_time, stop_time, position)
+                event = next(events, None)
+            except ClientError as error:
+                # the saved token may have expired, continue from the timestamp instead
+                if not position.get('token') or error.response['Error']['Code'] != 'InvalidParameterException':
+                    raise
+                position = {}
+                events = get_events(logs_client, group_name, stream_name, start_time, stop_time, position)
+                event = next(events, None)
 
+            while event:
+                write_event(writer, event, group_name, stream_name)
+                last_timestamp = max(last_timestamp or 0, event['timestamp'])
+                event = next(events, None)
+    except ClientError as error:
+        print('Stream is skipped: {}/{}, due to: {}'.format(group_name, stream_name, error))
     except Exception as e:
-        print('File is skipped: {}, due to: {}'.format(file_name, e))
+        print('File is skipped: {}, due to: {}'.format(writer.file_name, e))
+
+    if last_timestamp:
+        watermark = {'timestamp': last_timestamp, 'token': position.get('token'),
+                     'shard': writer.shard - 1 if writer.filenames else shard}
+
+    return writer.filenames, watermark
+
+
+def stream_writer(group_name, stream_name, output=None, start=1, append=False, directory=None, suffix=''):
+    output = dict(output or {})
+    ndjson = output.pop('ndjson', False)
+
+    groupname = re.sub('[^\w\s-]', '', group_name)
+    streamname = re.sub('[^\w\s-]', '', stream_name)
+    gr_st = groupname + '--' + streamname + suffix
 
-    return filenames
+    output.setdefault('max_records', None)
+    return common.ShardWriter('cw', gr_st, directory=directory or log_directory(), text=not ndjson, start=start,
+                              append=append, **output)
+
+
+def write_event(writer, event, group_name, stream_name):
+    if writer.text:
+        if event['message']:
+            writer.write(event['message'])
+    else:
+        event = dict(event, logGroupName=group_name, logStreamName=stream_name)
+        writer.write(event)
+
+
+def log_directory():
+    final_directory = os.path.join(os.getcwd(), r'cw_logs')
+    # the streams are downloaded by several threads at the same time
+    os.makedirs(final_directory, exist_ok=True)
+    return final_directory
+
+
+def load_state():
+    try:
+        with open(os.path.join(log_directory(), STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(state):
+    file_name = os.path.join(log_directory(), STATE_FILE)
+    with open(file_name + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(file_name + '.tmp', file_name)
 
 
 def print_table(values):
@@ -90,13 +281,23 @@ def print_table(values):
 
 
 def main():
-    description = '\n[*] Cloudwatch log scanner.\n'
-    '[*] The results will be saved to $currentpath/cw_logs folder.\n'
-    '[*] The logs are read for a specified number of hours until the current time. Default value: 24 hours.\n'
-    '[*] If a bucket is provided, the results are uploaded to the bucket. \n\n'
+    description = '\n[*] Cloudwatch log scanner.\n' \
+                  '[*] The results will be saved to $currentpath/cw_logs folder.\n' \
+                  '[*] The logs are read for a specified number of hours until the current time. Default value: 24 hours.\n' \
+                  '[*] New events are appended to the files of the previous run, streams without new events are skipped.\n' \
+                  '[*] With a filter pattern only the matching events are downloaded, filtered by CloudWatch.\n' \
+                  '[*] If a bucket is provided, the results are uploaded to the bucket. \n\n'
     optional_params = [['-b', '--bucketName', 'Specify the name of the bucket.'],
                        ['-t', '--time', 'Specify the number of hours to read the logs '
-                                        'until the current time. Default value: 24 hours.']]
+                                        'until the current time. Default value: 24 hours.'],
+                       ['-w', '--workers', 'Number of log streams downloaded at the same time. Default value: 8.'],
+                       ['-f', '--full', 'Ignore the watermarks of the previous run and collect the whole time window.',
+                        {'action': 'store_true'}],
+                       ['-p', '--filterPattern', 'Only collect the events matching this CloudWatch filter pattern. '
+                                                 'E.g.: "?AccessKeyId ?arn:aws ?ERROR"'],
+                       ['-x', '--streamPrefix', 'Comma separated log stream name prefixes for --filterPattern.'],
+                       ['-j', '--ndjson', 'Save the events as newline delimited JSON with their timestamps and metadata.',
+                        {'action': 'store_true'}]] + common.SHARD_PARAMS
 
     args, logs_client, s3_client = common.init(description, 'logs', optional_params)
 
@@ -108,9 +309,21 @@ def main():
     stop_time = int(datetime.datetime.utcnow().strftime("%s")) * 1000
 
     print('Collecting CloudWatch logs...')
-    filenames, values = list_and_save(logs_client, start_time, stop_time)
+    workers = int(args['workers'] or 8)
+    output = common.writer_options(args)
+    output['max_records'] = int(args['shardRecords']) if args['shardRecords'] else None
+    output['ndjson'] = args['ndjson']
+    if args['filterPattern']:
+        prefixes = args['streamPrefix'].split(',') if args['streamPrefix'] else None
+        filenames, values = filter_and_save(logs_client, start_time, stop_time, args['filterPattern'], prefixes,
+                                            workers, output)
+    else:
+        state = {} if args['full'] else load_state()
+        filenames, values = list_and_save(logs_client, start_time, stop_time, workers, state, output)
+        save_state(state)
 
     print_table(values)
+    common.print_throttling()
 
     if args['bucketName']:
         bucket_name = args['bucketName']
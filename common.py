@@ -3,23 +3,82 @@ import sys
 import json
 import requests
 import os
+import gzip
+import base64
+import decimal
+import hashlib
+import collections
+import threading
+import time
+import random
 import argparse
+import calendar
+import sqlite3
 from argparse import RawTextHelpFormatter
 from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from prettytable import PrettyTable
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MB = 1024 * 1024
+# botocore's default connection pool size per client
+MAX_POOL_CONNECTIONS = 10
+MANIFEST_FILE = 'upload_manifest.json'
+CACHE_FILE = 'froud_cache.sqlite'
+CACHE_TTL = 3600
+CACHE_MAX_ENTRIES = 10000
+
+IMDS_URL = 'http://169.254.169.254'
+IMDS_TIMEOUT = 2
+IMDS_TOKEN_TTL = 21600
+# the credentials are renewed this many seconds before they expire
+IMDS_REFRESH = 300
+# after a failed IMDSv2 token request IMDSv1 is used this many seconds, or until a request is rejected
+IMDS_FALLBACK = 600
+# the credentials are only kept on disk if this environment variable is set to 1
+IMDS_CACHE_VARIABLE = 'FROUD_IMDS_CACHE'
+IMDS_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'froud', 'imds_credentials.json')
+
+THROTTLING_ERRORS = ['ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded',
+                     'ProvisionedThroughputExceededException']
+MAX_RETRIES = 8
+MAX_BACKOFF = 20
+# lowest rate (calls/sec) the adaptive throttling slows a service down to
+MIN_RATE = 0.5
+
+SHARD_PARAMS = [['-z', '--compression', 'Compress the output shards: gzip or zstd.'],
+                ['-n', '--shardRecords', 'Maximum number of records per output shard. Default value: 1000.'],
+                ['-m', '--shardBytes', 'Maximum (uncompressed) size of an output shard in bytes.']]
+
+UPLOAD_PARAMS = [['-u', '--uploadWorkers', 'Number of files uploaded to the bucket at the same time. Default value: 4.'],
+                 ['-k', '--chunkSize', 'Multipart upload chunk size in MB. Default value: 8.'],
+                 ['-a', '--uploadAsWritten', 'Upload every output shard to the bucket as soon as it is written.',
+                  {'action': 'store_true'}]]
+
+POOL_PARAMS = [['-c', '--maxConnections', 'Maximum number of pooled connections per AWS client. '
+                                          'Default value: sized for the number of workers.']]
+
 
 def init(description, client_type, optional_params=None, required_params=None):
     if client_type in ["dynamodb", "sqs"]:
-        optional_params = [['-b', '--bucketName', 'Specify the name of the bucket.']]
+        optional_params = [['-b', '--bucketName', 'Specify the name of the bucket.']] + SHARD_PARAMS + \
+                          UPLOAD_PARAMS + (optional_params or [])
         if client_type == "dynamodb":
             required_params = [['-t', '--tableName', 'Specify the name of the table.']]
         else:
-            required_params = [['-q', '--queueName', 'Specify the name of the queue.']]
+            # not required, sqs.py can also sweep every queue
+            optional_params = [['-q', '--queueName', 'Specify the name of the queue.']] + optional_params
 
+    optional_params = (optional_params or []) + POOL_PARAMS
     args = parsing(description, optional_params=optional_params, required_params=required_params)
     config_success, data = load_config_json("conf.json")
-    client, s3_client = create_client(config_success, data, client_type)
+    client, s3_client = create_client(config_success, data, client_type, pool_size(args))
 
     return args, client, s3_client
 
@@ -40,33 +99,142 @@ def parsing(description, required_params=None, optional_params=None):
 
 def add_params(pars, params, req):
     for par in params:
-        pars.add_argument(par[0], par[1], help=par[2], required=req)
+        pars.add_argument(par[0], par[1], help=par[2], required=req, **(par[3] if len(par) > 3 else {}))
     return pars
 
 
 def init_keys():
-    access_key_id = get_keys_and_token("AccessKeyId")
-    secret_access_key = get_keys_and_token("SecretAccessKey")
-    token = get_keys_and_token("Token")
-
-    return access_key_id, secret_access_key, token
+    credentials = metadata_client().role_credentials()
+    return credentials['AccessKeyId'], credentials['SecretAccessKey'], credentials['Token']
 
 
 def get_keys_and_token(key):
-    try:
-        url = 'http://169.254.169.254/latest/meta-data/iam/security-credentials/'
-        role = requests.get(url).text
-        response = requests.get(url + str(role)).text
-    except requests.exceptions.RequestException as e:
-        print("Request error: {}".format(e))
-        sys.exit()
-    try:
-        text = json.loads(response)
-        final_request_value = text[key]
-    except Exception as e:
-        print("Error parsing " + str(key) + ": {}".format(e))
-        sys.exit()
-    return final_request_value
+    return metadata_client().role_credentials()[key]
+
+
+_metadata_client = None
+_metadata_lock = threading.Lock()
+
+
+def metadata_client():
+    # The process wide instance metadata client. With FROUD_IMDS_CACHE=1 the role credentials are also cached in
+    # ~/.cache/froud/imds_credentials.json, readable only by the user.
+    global _metadata_client
+    with _metadata_lock:
+        if _metadata_client is None:
+            cache_file = IMDS_CACHE_FILE if os.environ.get(IMDS_CACHE_VARIABLE) == '1' else None
+            _metadata_client = MetadataClient(cache_file=cache_file)
+        return _metadata_client
+
+
+class MetadataClient(object):
+    # Instance metadata service client: a single pooled session, IMDSv2 session tokens (falling back to IMDSv1),
+    # strict timeouts, and the role credentials cached until IMDS_REFRESH seconds before their Expiration.
+
+    def __init__(self, url=IMDS_URL, timeout=IMDS_TIMEOUT, cache_file=None, token_ttl=IMDS_TOKEN_TTL):
+        self.url = url
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.token_ttl = token_ttl
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.token = None
+        self.token_expiry = 0
+        self.fallback_expiry = 0
+        self.credentials = None
+        self.info = None
+
+    def _token(self, renew=False):
+        if self.token and not renew and time.time() < self.token_expiry:
+            return self.token
+        if not renew and time.time() < self.fallback_expiry:
+            return None
+        try:
+            response = self.session.put(self.url + '/latest/api/token', timeout=self.timeout,
+                                        headers={'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl)})
+        except requests.exceptions.RequestException:
+            response = None
+        if response is None or response.status_code != 200:
+            # IMDSv1 only, or the reply is dropped by the hop limit (e.g. in a container), the token is not
+            # asked for again until the fallback expires
+            self.token = None
+            self.fallback_expiry = time.time() + IMDS_FALLBACK
+            return None
+        self.token = response.text
+        self.token_expiry = time.time() + self.token_ttl - 60
+        return self.token
+
+    def get(self, path):
+        for renew in (False, True):
+            token = self._token(renew)
+            headers = {'X-aws-ec2-metadata-token': token} if token else {}
+            try:
+                response = self.session.get(self.url + '/latest/meta-data/' + path, headers=headers,
+                                            timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                print("Request error: {}".format(e))
+                sys.exit()
+            if response.status_code != 401:
+                break
+        if response.status_code != 200:
+            print("Instance metadata error: {} {}".format(response.status_code, path))
+            sys.exit()
+        return response.text
+
+    def iam_info(self):
+        with self.lock:
+            if self.info is None:
+                self.info = self._json(self.get('iam/info'), 'iam/info')
+            return self.info
+
+    def role_credentials(self):
+        with self.lock:
+            if not self._valid(self.credentials):
+                self.credentials = self._load()
+            if not self._valid(self.credentials):
+                role = self.get('iam/security-credentials/').split('\n')[0].strip()
+                self.credentials = self._json(self.get('iam/security-credentials/' + role), 'credentials')
+                self._save(self.credentials)
+            return self.credentials
+
+    @staticmethod
+    def _json(text, name):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            print("Error parsing " + name + ": {}".format(e))
+            sys.exit()
+
+    @staticmethod
+    def _valid(credentials):
+        if not credentials:
+            return False
+        try:
+            expiration = calendar.timegm(time.strptime(credentials['Expiration'], '%Y-%m-%dT%H:%M:%SZ'))
+        except (KeyError, ValueError):
+            return False
+        return time.time() < expiration - IMDS_REFRESH
+
+    def _load(self):
+        if not self.cache_file:
+            return None
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, credentials):
+        if not self.cache_file:
+            return
+        # only readable by the owner
+        directory = os.path.dirname(self.cache_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp_name = self.cache_file + '.tmp'
+        with os.fdopen(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(credentials, f)
+        os.replace(tmp_name, self.cache_file)
 
 
 def load_config_json(config_json_filename, sqs=None):
@@ -100,88 +268,362 @@ def load_config_json(config_json_filename, sqs=None):
     return True, data
 
 
-def create_client(config_success, data, client_type):
+def create_client(config_success, data, client_type, max_pool_connections=None):
     if not config_success:
-        session = boto3.Session()
-        client = session.client(client_type)
-        s3_client = session.client('s3')
+        credentials = None
+        region_name = None
     else:
         aws_access_key_id, aws_secret_access_key, aws_session_token, region_name = data
-        session = boto3.Session(aws_access_key_id=aws_access_key_id,
-                                aws_secret_access_key=aws_secret_access_key,
-                                aws_session_token=aws_session_token)
+        credentials = (aws_access_key_id, aws_secret_access_key, aws_session_token)
 
-        try:
-            if client_type == 'sqs':
-                client = boto3.resource('sqs', region_name=region_name)
-            else:
-                client = session.client(client_type, region_name)
-            s3_client = session.client('s3')
-        except ValueError as error:
-            print('Error: {}'.format(error))
-            sys.exit()
+    try:
+        client = client_pool.client(client_type, region_name, credentials, max_pool_connections=max_pool_connections)
+        s3_client = client_pool.client('s3', None, credentials, max_pool_connections=max_pool_connections)
+    except ValueError as error:
+        print('Error: {}'.format(error))
+        sys.exit()
     return client, s3_client
 
 
-def write_to_file_1000(service, resource_name, data):
+def pool_size(args):
+    # Enough connections for every worker thread of the scripts, plus one for the helper threads.
+    if args.get('maxConnections'):
+        return int(args['maxConnections'])
+    workers = [int(args[key]) for key in ('workers', 'receivers', 'segments', 'uploadWorkers') if args.get(key)]
+    return max([MAX_POOL_CONNECTIONS] + [n + 1 for n in workers])
+
+
+class ClientPool(object):
+    # Process wide boto3 sessions and clients, created lazily and shared by every thread.
+    # Clients are keyed by (service, region, credentials, endpoint, max_pool_connections), so the scanners reuse
+    # warm connections instead of paying for new sessions and TLS handshakes.
+
+    def __init__(self, max_pool_connections=MAX_POOL_CONNECTIONS):
+        self.max_pool_connections = max_pool_connections
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.clients = {}
+
+    def session(self, credentials=None, region=None):
+        # credentials: (access key id, secret access key, session token), None uses the default provider chain
+        credentials = tuple(credentials) if credentials and any(credentials) else None
+        key = (credentials, region)
+        with self.lock:
+            if key not in self.sessions:
+                access_key, secret_key, token = credentials or (None, None, None)
+                self.sessions[key] = boto3.Session(aws_access_key_id=access_key or None,
+                                                   aws_secret_access_key=secret_key or None,
+                                                   aws_session_token=token or None, region_name=region or None)
+            return self.sessions[key]
+
+    def client(self, service, region=None, credentials=None, endpoint_url=None, max_pool_connections=None):
+        session = self.session(credentials, region)
+        max_pool_connections = max_pool_connections or self.max_pool_connections
+        key = (service, region, credentials and tuple(credentials), endpoint_url, max_pool_connections)
+        with self.lock:
+            # creating clients from a session is not thread safe
+            if key not in self.clients:
+                self.clients[key] = session.client(service, endpoint_url=endpoint_url,
+                                                   config=Config(max_pool_connections=max_pool_connections))
+            return self.clients[key]
+
+
+client_pool = ClientPool()
+
+
+def scan_directory(service):
+    final_directory = os.path.join(os.getcwd(), r'{}_scan'.format(service))
+    # the swept queues and the scan segments create their writers at the same time
+    os.makedirs(final_directory, exist_ok=True)
+    return final_directory
+
+
+Shard = collections.namedtuple('Shard', 'file_name sha256 records size last_record')
+
 
-    print('Writing files...')
-    current_directory = os.getcwd()
-    final_directory = os.path.join(current_directory, r'{}_scan'.format(service))
-    if not os.path.exists(final_directory):
-        os.makedirs(final_directory)
+class HashingFile(object):
+    # Hashes everything that is written to the underlying file, so the digest
+    # of the (compressed) shard is known as soon as it is closed.
 
-    count = 1
-    filenames = []
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
 
-    while len(data) > 0:
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.f.write(data)
 
-        if len(data) <= 1000:
-            file_name = final_directory + '/' + resource_name + '-' + str(count) + '-' + str(count+999) + '.txt'
-            filenames.append(file_name)
-            with open(file_name, 'w+') as f:
-                for line in data:
-                    f.write(json.dumps(line))
-                del data[:]
+    def hash_existing(self, file_name):
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(MB), b''):
+                self.hash.update(block)
+                self.size += len(block)
 
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ShardWriter(object):
+    # Streams records as newline delimited JSON into $currentpath/<service>_scan/<resource_name>-<n>.ndjson
+    # files. A new shard is started after max_records records or max_bytes (uncompressed) bytes,
+    # shards can be compressed with gzip or zstd. on_close(shard) is called for every finished shard.
+    # With text=True the records are strings written as plain lines into .txt files, with append=True
+    # the first shard is continued if it already exists.
+
+    extensions = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, service, resource_name, max_records=1000, max_bytes=None, compression=None,
+                 start=1, on_close=None, directory=None, text=False, append=False):
+        if compression not in self.extensions:
+            print('Invalid compression: {}. Choose from gzip, zstd.'.format(compression))
+            sys.exit()
+        if compression == 'zstd' and not zstandard:
+            print('The zstandard package is required for zstd compression.')
+            sys.exit()
+
+        self.directory = directory or scan_directory(service)
+        self.resource_name = resource_name
+        self.text = text
+        self.append = append
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.shard = start
+        self.on_close = on_close
+        self.filenames = []
+        self.hashes = {}
+        self.records = 0
+
+        self.raw = None
+        self.out = None
+        self.file_name = None
+        self.shard_records = 0
+        self.shard_bytes = 0
+        self.last_record = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self):
+        self.file_name = '{}/{}-{:05d}{}{}'.format(self.directory, self.resource_name, self.shard,
+                                                   '.txt' if self.text else '.ndjson',
+                                                   self.extensions[self.compression])
+        # gzip members and zstd frames can be concatenated, so compressed shards can be appended too
+        if self.append and os.path.exists(self.file_name):
+            self.raw = HashingFile(open(self.file_name, 'ab'))
+            self.raw.hash_existing(self.file_name)
         else:
-            file_name = final_directory + '/' + resource_name + str(count) + '.txt'
-            filenames.append(file_name)
-            with open(file_name, 'w+') as f:
-                for line in data[:1000]:
-                    f.write(json.dumps(line))
-                del data[:1000]
-        count += 1000
+            self.raw = HashingFile(open(self.file_name, 'wb'))
+        self.append = False
+        if self.compression == 'gzip':
+            self.out = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, mtime=0)
+        elif self.compression == 'zstd':
+            self.out = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.out = self.raw
+        self.shard_records = 0
+        self.shard_bytes = self.raw.size
+
+    def _close_shard(self):
+        if self.out is not self.raw:
+            self.out.close()
+        self.raw.close()
+
+        shard = Shard(self.file_name, self.raw.hash.hexdigest(), self.shard_records, self.raw.size, self.last_record)
+        self.filenames.append(self.file_name)
+        self.hashes[self.file_name] = shard.sha256
+        self.out = None
+        self.raw = None
+        self.shard += 1
+        if self.on_close:
+            self.on_close(shard)
+
+    def write(self, record):
+        if self.out and ((self.max_records and self.shard_records >= self.max_records) or
+                         (self.max_bytes and self.shard_bytes >= self.max_bytes)):
+            self._close_shard()
+        if not self.out:
+            self._open()
+
+        if self.text:
+            line = (record + '\n').encode('utf-8')
+        else:
+            line = (json.dumps(record, default=json_default) + '\n').encode('utf-8')
+        self.out.write(line)
+        self.shard_records += 1
+        self.shard_bytes += len(line)
+        self.records += 1
+        self.last_record = record
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self.out:
+            self.out.flush()
+
+    def close(self):
+        if self.out:
+            self._close_shard()
+        return self.filenames
+
+
+def json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def writer_options(args):
+    return {'max_records': int(args.get('shardRecords') or 1000),
+            'max_bytes': int(args['shardBytes']) if args.get('shardBytes') else None,
+            'compression': args.get('compression')}
+
+
+class Uploader(object):
+    # Shared S3 transfer manager. Files are uploaded by a pool of workers, so shards can be
+    # submitted while the scan is still running (upload-as-written).
+    # The sha256 of every uploaded file is kept in $currentpath/upload_manifest.json and in the object's
+    # metadata, unchanged files are not uploaded again.
+
+    def __init__(self, s3_client, bucket_name, workers=4, chunk_size=8 * MB, manifest=MANIFEST_FILE):
+        connections = s3_client.meta.config.max_pool_connections or MAX_POOL_CONNECTIONS
+        config = boto3.s3.transfer.TransferConfig(multipart_chunksize=chunk_size,
+                                                  max_concurrency=max(1, connections // workers))
+        self.s3_client = s3_client
+        self.transfer = boto3.s3.transfer.S3Transfer(client=s3_client, config=config)
+        self.bucket_name = bucket_name
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.start = time.time()
+
+        self.manifest_file = manifest
+        self.manifest = load_manifest(manifest)
+        self.uploaded = self.manifest.setdefault(bucket_name, {})
+
+    def submit(self, file_name, sha256=None):
+        with self.lock:
+            if file_name not in self.futures:
+                self.futures[file_name] = self.executor.submit(self.upload, file_name, sha256)
+
+    def on_close(self, shard):
+        self.submit(shard.file_name, shard.sha256)
+
+    def upload(self, file_name, sha256=None):
+        key = file_name.split('/')[-2:]
+        key = key[0] + '/' + key[1]
+        size = os.path.getsize(file_name)
+        sha256 = sha256 or file_sha256(file_name)
+
+        if self.uploaded.get(key) == sha256 and self.remote_sha256(key) == sha256:
+            return 0, size
 
-    print('Files can be found in $currentpath/{}_scan folder.'.format(service))
+        try:
+            self.transfer.upload_file(file_name, self.bucket_name, key,
+                                      extra_args={'ACL': 'public-read', 'Metadata': {'sha256': sha256}})
+        except S3UploadFailedError:
+            print('File upload is not successful: PutObject permission missing.')
+            return 0, 0
 
-    return filenames
+        with self.lock:
+            self.uploaded[key] = sha256
+        file_url = 'https://{}.s3.amazonaws.com/{}'.format(self.bucket_name, key)
+        print('The uploaded file is public and accessible with the following url: \n    {}'.format(file_url))
+        return size, 0
 
+    def remote_sha256(self, key):
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError:
+            return None
+        return response.get('Metadata', {}).get('sha256')
+
+    def wait(self, filenames=(), hashes=None):
+        # a failed upload does not stop the others, the manifest keeps every successful one
+        results = []
+        failures = []
+        try:
+            for file_name in filenames:
+                self.submit(file_name, (hashes or {}).get(file_name))
+            for file_name, future in list(self.futures.items()):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    failures.append((file_name, e))
+        finally:
+            self.executor.shutdown()
+            save_manifest(self.manifest_file, self.manifest)
+
+        for file_name, error in failures:
+            print('Upload of {} failed: {}'.format(file_name, error))
+        elapsed = time.time() - self.start
+        size = sum(uploaded for uploaded, skipped in results)
+        print('Uploaded {} files ({:.1f} MB) to the bucket {} in {:.1f}s ({:.1f} MB/s).'.format(
+            len([uploaded for uploaded, skipped in results if uploaded]), size / float(MB), self.bucket_name,
+            elapsed, size / float(MB) / max(elapsed, 0.001)))
+        skipped = [skipped for uploaded, skipped in results if skipped]
+        if skipped:
+            print('Skipped {} unchanged files, {:.1f} MB saved.'.format(len(skipped), sum(skipped) / float(MB)))
+
+
+def load_manifest(file_name):
+    try:
+        with open(file_name, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-def bucket_upload(bucket, s3_client, filenames):
+
+def save_manifest(file_name, manifest):
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_name, file_name)
+
+
+def file_sha256(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def create_uploader(args, s3_client):
+    if not args.get('bucketName'):
+        return None
+    return Uploader(s3_client, args['bucketName'], workers=int(args.get('uploadWorkers') or 4),
+                    chunk_size=int(args.get('chunkSize') or 8) * MB)
+
+
+def bucket_upload(bucket, s3_client, filenames, uploader=None, hashes=None):
     if bucket:
         bucket_name = bucket
         try:
-            upload_files(s3_client, filenames, bucket_name)
+            upload_files(s3_client, filenames, bucket_name, uploader, hashes)
         except Exception as e:
             print(e)
 
 
-def upload_files(s3_client, filenames, bucket_name):
+def upload_files(s3_client, filenames, bucket_name, uploader=None, hashes=None):
 
     print('Uploading files to the bucket {}...'.format(bucket_name))
-    for f in filenames:
-        try:
-            key = f.split('/')[-2:]
-            key = key[0] + '/' + key[1]
-            tc = boto3.s3.transfer.TransferConfig()
-            t = boto3.s3.transfer.S3Transfer(client=s3_client, config=tc)
-            t.upload_file(f, bucket_name, key, extra_args={'ACL': 'public-read'})
-
-            file_url = 'https://{}.s3.amazonaws.com/{}'.format(bucket_name, key)
-            print('The uploaded file is public and accessible with the following url: \n    {}'.format(file_url))
-        except S3UploadFailedError:
-            print('File upload is not successful: PutObject permission missing.')
+    uploader = uploader or Uploader(s3_client, bucket_name)
+    uploader.wait(filenames, hashes)
 
 
 def print_table(values, fieldnames):
@@ -197,6 +639,218 @@ def print_table(values, fieldnames):
     print(x)
 
 
+def add_cache_params(parser):
+    parser.add_argument('--refresh', help='Ignore the cached results and query the API again.', action='store_true')
+    parser.add_argument('--cacheTtl', help='Maximum age of the cached results in seconds. Default value: {}.'
+                        .format(CACHE_TTL), required=False)
+    return parser
+
+
+def create_cache(args):
+    return Cache(ttl=int(args.get('cacheTtl') or CACHE_TTL), refresh=args.get('refresh'))
+
+
+class Cache(object):
+    # Results of the list/describe APIs in $currentpath/froud_cache.sqlite, so repeated runs do not enumerate
+    # everything again. Entries are keyed by account, region, service, credential identity and name, expire after
+    # ttl seconds (never if ttl is None) and the least recently used entries are dropped above max_entries.
+    # The inventory of resource.py is stored with the name 'resources', e.g. get(identity, 'us-east-1', 'sqs',
+    # 'resources') returns the [service, region, type, name] rows of the queues.
+
+    def __init__(self, file_name=CACHE_FILE, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, refresh=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(os.getcwd(), file_name), check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, '
+                            'created REAL, accessed REAL)')
+
+    @staticmethod
+    def key(identity, region, service, name):
+        account, arn = identity
+        return '|'.join([account, region or 'global', service, arn, name])
+
+    def get(self, identity, region, service, name):
+        if self.refresh:
+            return None
+        key = self.key(identity, region, service, name)
+        with self.lock:
+            row = self.db.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+            if not row or (self.ttl is not None and row[1] + self.ttl < time.time()):
+                return None
+            with self.db:
+                self.db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, identity, region, service, name, value):
+        key = self.key(identity, region, service, name)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                            (key, json.dumps(value, default=json_default), now, now))
+            self.db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC '
+                            'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def delete(self, identity, region, service, name):
+        # Drops the entry, e.g. after a call that changed the listed resources.
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM cache WHERE key = ?', (self.key(identity, region, service, name),))
+
+    def cached(self, identity, region, service, name, function, *args, **kwargs):
+        # Returns the cached value, or calls the function and caches its result.
+        value = self.get(identity, region, service, name)
+        if value is None:
+            value = function(*args, **kwargs)
+            self.set(identity, region, service, name, value)
+        return value
+
+    def identity(self, session):
+        # The account and arn of the session's credentials, cached by a digest of the access key.
+        credentials = session.get_credentials()
+        access_key = credentials.access_key if credentials else ''
+        digest = hashlib.sha256(access_key.encode('utf-8')).hexdigest()[:16]
+
+        def _caller_identity():
+            try:
+                response = session.client('sts').get_caller_identity()
+            except ClientError as error:
+                exception(error, 'Get caller identity failed.')
+            return [response['Account'], response['Arn']]
+
+        return tuple(self.cached(('', digest), None, 'sts', 'identity', _caller_identity))
+
+    def close(self):
+        self.db.close()
+
+
+class RateLimiter(object):
+    # Spaces out acquire() calls so that at most rate units are taken per second, None means unlimited.
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, units=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(self.next_time, now) + units / float(self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveThrottle(object):
+    # Rate and concurrency control of one service, shared by all of its workers. Both start unlimited, a throttling
+    # error cuts them to decrease times the current values (at most once per second), every successful call raises
+    # them additively, so the workers settle at the highest rate the account tolerates.
+
+    def __init__(self, service, max_rate=None, decrease=0.5, increase=1.0):
+        self.service = service
+        self.max_rate = max_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.rate = max_rate
+        self.limit = None
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.next_time = time.time()
+        self.last_cut = 0
+        self.recent = collections.deque()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.limit is not None and self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            now = time.time()
+            wait = 0
+            if self.rate:
+                wait = self.next_time - now
+                self.next_time = max(self.next_time, now) + 1.0 / self.rate
+            # the calls of the last second, the rate the service accepted before it throttled
+            self.recent.append(now + max(0, wait))
+            while self.recent and self.recent[0] < now - 1:
+                self.recent.popleft()
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                now = time.time()
+                if now - self.last_cut >= 1:
+                    self.last_cut = now
+                    observed = float(max(1, len(self.recent)))
+                    self.rate = max(MIN_RATE, min(self.rate or observed, observed) * self.decrease)
+                    self.limit = max(1, int((self.limit or self.in_flight + 1) * self.decrease))
+                    self.successes = 0
+            else:
+                if self.rate is not None:
+                    # about increase calls/sec more every second
+                    self.rate += self.increase / self.rate
+                    if self.max_rate:
+                        self.rate = min(self.rate, self.max_rate)
+                if self.limit is not None:
+                    self.successes += 1
+                    if self.successes >= self.limit:
+                        self.limit += 1
+                        self.successes = 0
+            self.condition.notify_all()
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+def throttle(service):
+    with _throttles_lock:
+        if service not in _throttles:
+            _throttles[service] = AdaptiveThrottle(service)
+        return _throttles[service]
+
+
+def service_name(function):
+    # The service of a bound client method, e.g. dynamo.scan -> dynamodb
+    meta = getattr(getattr(function, '__self__', None), 'meta', None)
+    service_model = getattr(meta, 'service_model', None)
+    return service_model.service_name if service_model else 'default'
+
+
+def with_backoff(function, *args, **kwargs):
+    # Retries throttled API calls with exponential backoff and full jitter.
+    # The calls of a service share its AdaptiveThrottle, which slows every worker down after a throttling error.
+    control = throttle(service_name(function))
+    for attempt in range(MAX_RETRIES):
+        control.acquire()
+        throttled = False
+        try:
+            return function(*args, **kwargs)
+        except ClientError as error:
+            throttled = error.response['Error']['Code'] in THROTTLING_ERRORS
+            if not throttled or attempt == MAX_RETRIES - 1:
+                raise
+        finally:
+            control.release(throttled)
+        time.sleep(random.uniform(0, min(MAX_BACKOFF, 0.1 * 2 ** attempt)))
+
+
+def print_throttling():
+    with _throttles_lock:
+        throttles = [control for control in _throttles.values() if control.throttled]
+    for control in throttles:
+        print('[{}] {} calls were throttled, settled at {:.1f} calls/sec with {} concurrent calls.'.format(
+            control.service, control.throttled, control.rate, control.limit))
+
+
 def exception(error, fail):
     resp = error.response['Error']['Code']
     if resp == 'AccessDenied':
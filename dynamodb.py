@@ -1,48 +1,336 @@
 from botocore.exceptions import ClientError
 import common
 import sys
+import os
+import json
+import time
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import EndpointConnectionError
 
+print_lock = threading.Lock()
 
-def scan_table(table, dynamo):
+# read request units per second a new on-demand table serves (and 4000 write request units)
+ON_DEMAND_RCU = 12000
 
+
+class CapacityLimiter(object):
+    # Holds the read capacity consumed by all scan workers at target units per second. A page is only requested
+    # when the balance is not negative and the consumed capacity it reports is taken afterwards, so the
+    # overshoot is at most one page per worker.
+
+    def __init__(self, target):
+        self.target = float(target)
+        # no initial burst, the table's own burst capacity belongs to the application
+        self.balance = 0.0
+        self.updated = time.time()
+        self.consumed = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.balance = min(self.target, self.balance + (now - self.updated) * self.target)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.balance >= 0:
+                    return
+                wait = -self.balance / self.target
+            time.sleep(wait)
+
+    def consume(self, units):
+        with self.lock:
+            self._refill()
+            self.balance -= units
+            self.consumed += units
+
+
+class Checkpoint(object):
+    # Keeps the last written key of every segment in $currentpath/dynamodb_scan/<table>.checkpoint
+    # so that an interrupted export continues where it stopped.
+
+    def __init__(self, table, total_segments):
+        self.file_name = os.path.join(common.scan_directory('dynamodb'), table + '.checkpoint')
+        self.total_segments = total_segments
+        self.lock = threading.Lock()
+        self.segments = {}
+
+        try:
+            with open(self.file_name, 'r') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if saved.get('total_segments') != total_segments:
+            print('Checkpoint found with {} segments, starting a new scan.'.format(saved.get('total_segments')))
+            return
+        self.segments = saved['segments']
+        print('Resuming the scan from checkpoint: {}'.format(self.file_name))
+
+    def get(self, segment):
+        state = self.segments.get(str(segment), {})
+        return (decode_key(state.get('key')), state.get('items', 0), state.get('shard', 1),
+                state.get('files', []), state.get('done', False))
+
+    def update(self, segment, key, items, shard, files, done=False):
+        with self.lock:
+            self.segments[str(segment)] = {'key': encode_key(key), 'items': items, 'shard': shard,
+                                           'files': files, 'done': done}
+            tmp_name = self.file_name + '.tmp'
+            with open(tmp_name, 'w') as f:
+                json.dump({'total_segments': self.total_segments, 'segments': self.segments}, f)
+            os.replace(tmp_name, self.file_name)
+
+    def remove(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+def encode_key(key):
+    if not key:
+        return None
+    encoded = {}
+    for name, value in key.items():
+        if 'B' in value:
+            value = {'B': base64.b64encode(value['B']).decode('ascii')}
+        encoded[name] = value
+    return encoded
+
+
+def decode_key(key):
+    if not key:
+        return None
+    decoded = {}
+    for name, value in key.items():
+        if 'B' in value:
+            value = {'B': base64.b64decode(value['B'])}
+        decoded[name] = value
+    return decoded
+
+
+def scan_pages(table, dynamo, segment=None, total_segments=None, start_key=None, scan_options=None, capacity=None):
+    # scan_options holds extra Scan parameters (Limit, ProjectionExpression, ConsistentRead...),
+    # with a CapacityLimiter every page reports its consumed capacity and waits for its share.
+
+    kwargs = dict(scan_options or {}, TableName=table)
+    if total_segments and total_segments > 1:
+        kwargs['Segment'] = segment
+        kwargs['TotalSegments'] = total_segments
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+    if capacity:
+        kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+
+    while True:
+        try:
+            if capacity:
+                capacity.acquire()
+            response = common.with_backoff(dynamo.scan, **kwargs)
+            if capacity:
+                capacity.consume(response.get('ConsumedCapacity', {}).get('CapacityUnits', 0))
+        except EndpointConnectionError as error:
+            print('The requested table could not be reached. \n{}'.format(error))
+            sys.exit()
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ResourceNotFoundException':
+                print('Requested table not found.')
+                print(error)
+                sys.exit()
+            else:
+                common.exception(error, 'Scan dynamodb table failed.')
+
+        yield response
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def scan_table(table, dynamo, segment=0, total_segments=1, start_key=None, key_names=None, scan_options=None,
+               capacity=None):
+    # Yields the items page by page, only a single page is held in memory.
+    # The key attribute names are collected into key_names for checkpointing.
+
+    for response in scan_pages(table, dynamo, segment, total_segments, start_key, scan_options, capacity):
+        if key_names is not None and not key_names and 'LastEvaluatedKey' in response:
+            key_names.extend(response['LastEvaluatedKey'].keys())
+        for item in response['Items']:
+            yield item
+
+
+def scan_segment(table, dynamo, segment, total_segments, checkpoint, writer_options=None, uploader=None,
+                 scan_options=None, capacity=None):
+    start_key, written, shard, filenames, done = checkpoint.get(segment)
+    if done:
+        report_progress(segment, total_segments, written, time.time(), done=True)
+        return filenames, 0, {}
+
+    start = time.time()
+    key_names = list(start_key.keys()) if start_key else []
+
+    def _on_close(closed):
+        filenames.append(closed.file_name)
+        if uploader:
+            uploader.on_close(closed)
+        if key_names:
+            last_key = dict((name, closed.last_record[name]) for name in key_names)
+            checkpoint.update(segment, last_key, written + writer.records, writer.shard, filenames)
+        if total_segments > 1:
+            report_progress(segment, total_segments, writer.records, start)
+
+    resource_name = table if total_segments == 1 else '{}-segment{}'.format(table, segment)
+    writer = common.ShardWriter('dynamodb', resource_name, start=shard, on_close=_on_close, **(writer_options or {}))
+    with writer:
+        writer.write_all(scan_table(table, dynamo, segment, total_segments, start_key, key_names, scan_options,
+                                    capacity))
+
+    checkpoint.update(segment, None, written + writer.records, writer.shard, filenames, done=True)
+    if total_segments > 1:
+        report_progress(segment, total_segments, writer.records, start, done=True)
+    return filenames, writer.records, writer.hashes
+
+
+def parallel_scan(table, dynamo, total_segments, workers=None, writer_options=None, uploader=None, scan_options=None,
+                  capacity=None):
+    if total_segments > 1:
+        print('Scanning the table in {} segments...'.format(total_segments))
+    else:
+        print('Scanning the table...')
+    start = time.time()
+    checkpoint = Checkpoint(table, total_segments)
+    filenames = []
+    hashes = {}
+    total = 0
+
+    with ThreadPoolExecutor(max_workers=workers or total_segments) as executor:
+        futures = [executor.submit(scan_segment, table, dynamo, segment, total_segments, checkpoint,
+                                   writer_options, uploader, scan_options, capacity)
+                   for segment in range(total_segments)]
+        for future in futures:
+            segment_filenames, count, segment_hashes = future.result()
+            filenames += segment_filenames
+            hashes.update(segment_hashes)
+            total += count
+
+    checkpoint.remove()
+    common.print_throttling()
+    elapsed = time.time() - start
+    print('Scanned {} items in {:.1f}s ({:.1f} items/sec).'.format(total, elapsed, total / max(elapsed, 0.001)))
+    if capacity:
+        print('Consumed {:.1f} read capacity units ({:.1f} RCU/sec, target {:.1f} RCU/sec).'.format(
+            capacity.consumed, capacity.consumed / max(elapsed, 0.001), capacity.target))
+    print('Files can be found in $currentpath/dynamodb_scan folder.')
+    return filenames, hashes
+
+
+def describe_table(table, dynamo):
     try:
-        response = dynamo.scan(TableName=table)
+        return dynamo.describe_table(TableName=table)['Table']
     except EndpointConnectionError as error:
         print('The requested table could not be reached. \n{}'.format(error))
         sys.exit()
     except ClientError as error:
         if error.response['Error']['Code'] == 'ResourceNotFoundException':
             print('Requested table not found.')
-            print(error)
             sys.exit()
-        else:
-            common.exception(error, 'Scan dynamodb table failed.')
+        common.exception(error, 'Describe dynamodb table failed.')
+
+
+def read_capacity(description):
+    # The provisioned read capacity of the table, or the maximum/warm throughput of an on-demand table.
+    if description.get('BillingModeSummary', {}).get('BillingMode') == 'PAY_PER_REQUEST':
+        maximum = description.get('OnDemandThroughput', {}).get('MaxReadRequestUnits', -1)
+        if maximum > 0:
+            return maximum
+        # the throughput the table serves right away, it grows with the table's previous peak
+        return description.get('WarmThroughput', {}).get('ReadUnitsPerSecond') or ON_DEMAND_RCU
+    return description['ProvisionedThroughput']['ReadCapacityUnits']
+
 
-    print('Scanning the table...')
-    data = response['Items']
+def capacity_target(description, max_rcu=None, rcu_percent=None):
+    target = read_capacity(description) * rcu_percent / 100.0 if rcu_percent else None
+    if max_rcu:
+        target = min(target, max_rcu) if target else max_rcu
+    return target
 
-    while 'LastEvaluatedKey' in response:
-        response = dynamo.scan(TableName=table, ExclusiveStartKey=response['LastEvaluatedKey'])
-        data.extend(response['Items'])
 
-    return data
+def page_limit(description, target, workers, consistent_read=False):
+    # Items per page so that a page of every worker costs about its share of one second's capacity.
+    # A read of 4KB costs 1 RCU, or 0.5 RCU if it is eventually consistent.
+    if not description.get('ItemCount') or not description.get('TableSizeBytes'):
+        return None
+    item_size = description['TableSizeBytes'] / float(description['ItemCount'])
+    item_units = item_size / 4096.0 * (1.0 if consistent_read else 0.5)
+    return max(1, int(target / workers / item_units))
+
+
+def projection(attributes, description):
+    # The key attributes are always read, the checkpoints are made from them.
+    names = [name.strip() for name in attributes.split(',') if name.strip()]
+    names += [key['AttributeName'] for key in description['KeySchema'] if key['AttributeName'] not in names]
+    return {'ProjectionExpression': ', '.join('#p{}'.format(n) for n in range(len(names))),
+            'ExpressionAttributeNames': dict(('#p{}'.format(n), name) for n, name in enumerate(names))}
+
+
+def report_progress(segment, total_segments, count, start, done=False):
+    elapsed = time.time() - start
+    with print_lock:
+        print('[segment {}/{}] {} {} items ({:.1f} items/sec)'.format(
+            segment + 1, total_segments, 'finished with' if done else 'scanned',
+            count, count / max(elapsed, 0.001)))
 
 
 def main():
     description = "\n[*] Scanner for DynamoDB tables.\n" \
                       "[*] The results will be saved to $currentpath/dynamodb_scan folder.\n" \
-                      "[*] If a bucket is provided, the results are uploaded to the bucket. \n\n"
+                      "[*] If a bucket is provided, the results are uploaded to the bucket. \n" \
+                      "[*] If segments are provided, the table is scanned in parallel, one output shard per segment. \n" \
+                      "[*] An interrupted scan is resumed from $currentpath/dynamodb_scan/<TableName>.checkpoint. \n" \
+                      "[*] With a read capacity target every page reports its consumed capacity and the workers are \n" \
+                      "    paced to hold the table's consumed read capacity at the target. \n\n"
+    optional_params = [['-s', '--segments', 'Number of parallel scan segments (TotalSegments).'],
+                       ['-w', '--workers', 'Number of scanner threads. Default value: number of segments.'],
+                       ['-r', '--maxRcu', 'Maximum read capacity units consumed per second.'],
+                       ['-p', '--rcuPercent', 'Maximum share of the table\'s read capacity consumed, in percent.'],
+                       ['-l', '--limit', 'Number of items per page. Default value: sized for the capacity target.'],
+                       ['-e', '--projection', 'Comma separated attributes to read, the key attributes are always read.'],
+                       ['-o', '--consistentRead', 'Use strongly consistent reads, they cost twice as much capacity.',
+                        {'action': 'store_true'}]]
 
-    arguments, dynamo_client, s3_client = common.init(description, 'dynamodb')
+    arguments, dynamo_client, s3_client = common.init(description, 'dynamodb', optional_params)
 
     table = str(arguments['tableName'])
 
-    data = scan_table(table, dynamo_client)
-    filenames = common.write_to_file_1000('dynamodb', table, data)
+    segments = int(arguments['segments'] or arguments['workers'] or 1)
+    workers = int(arguments['workers'] or segments)
+    scan_options = {'ConsistentRead': bool(arguments['consistentRead'])}
+    capacity = None
+    if arguments['maxRcu'] or arguments['rcuPercent'] or arguments['projection']:
+        description = describe_table(table, dynamo_client)
+        if arguments['projection']:
+            scan_options.update(projection(arguments['projection'], description))
+        target = capacity_target(description, float(arguments['maxRcu']) if arguments['maxRcu'] else None,
+                                 float(arguments['rcuPercent']) if arguments['rcuPercent'] else None)
+        if target:
+            capacity = CapacityLimiter(target)
+            limit = page_limit(description, target, workers, arguments['consistentRead'])
+            print('Target read capacity: {:.1f} RCU/sec of {} RCU{}.'.format(
+                target, read_capacity(description), ', {} items per page'.format(limit) if limit else ''))
+            if limit:
+                scan_options['Limit'] = limit
+    if arguments['limit']:
+        scan_options['Limit'] = int(arguments['limit'])
+
+    uploader = common.create_uploader(arguments, s3_client)
+    filenames, hashes = parallel_scan(table, dynamo_client, segments, workers, common.writer_options(arguments),
+                                      uploader if arguments['uploadAsWritten'] else None, scan_options, capacity)
 
     if arguments['bucketName']:
-        common.bucket_upload(arguments['bucketName'], s3_client, filenames)
+        common.bucket_upload(arguments['bucketName'], s3_client, filenames, uploader, hashes)
 
 
 if __name__ == '__main__':
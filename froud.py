@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import importlib
+import argparse
+from argparse import RawTextHelpFormatter
+
+START = time.time()
+
+# The scanners are only imported when they run, so the help and the simple subcommands
+# do not pay for boto3, prettytable, requests and kitty.
+COMMANDS = [('resource', 'Lists available resources with the given credentials.'),
+            ('rolepolicies', 'Lists inline and managed policies attached to the role of the instance profile.'),
+            ('dynamodb', 'Scans the given DynamoDB table.'),
+            ('sqs', 'Scans the given SQS queue or sweeps every queue.'),
+            ('cloudwatch', 'Scans the available Cloudwatch logs.'),
+            ('lambda', 'Lists the Lambda functions and uploads a new one.'),
+            ('fuzzer', 'Sends fuzz messages to SQS, SNS, Lambda and HTTP targets.'),
+            ('collect-all', 'Runs resource, rolepolicies, dynamodb, sqs and cloudwatch at the same time.')]
+
+# seconds from the start of the process until the subcommand starts running, the interpreter's own startup
+# included; a command imports boto3, which alone takes about 0.25s
+STARTUP_BUDGET = {'help': 0.3, 'command': 1.0}
+
+COLLECT_ALL = ['resource', 'rolepolicies', 'dynamodb', 'sqs', 'cloudwatch']
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        prog='froud.py',
+        description='[*] Runs the froud tools as subcommands.\n\n' +
+                    '\n'.join('   {:<14}{}'.format(name, help_text) for name, help_text in COMMANDS) +
+                    '\n\n[*] Use "froud.py <command> -h" for the options of a command.',
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--timing', help='Print the startup time of the command and its budget.', action='store_true')
+    parser.add_argument('command', choices=[name for name, _ in COMMANDS], metavar='command')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    return vars(parser.parse_args())
+
+
+def startup_time():
+    # Seconds since the process started, read from /proc on Linux. Elsewhere only the time since the runner
+    # was loaded is known.
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the command name, starttime is the 22nd field, in clock ticks after boot
+            start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return time.time() - START
+
+
+def report_startup(name, budget):
+    elapsed = startup_time()
+    print('[timing] {} started in {:.3f}s (budget {:.3f}s){}'.format(
+        name, elapsed, budget, '' if elapsed <= budget else ', over budget'))
+
+
+def run_command(name, argv, timing=False):
+    # The scripts parse sys.argv themselves.
+    sys.argv = ['{}.py'.format(name)] + argv
+    module = importlib.import_module(name)
+    if timing:
+        report_startup(name, STARTUP_BUDGET['command'])
+    module.main()
+
+
+def collect_all(argv, timing=False):
+    import common
+    from concurrent.futures import ThreadPoolExecutor
+
+    sys.argv = ['froud.py collect-all'] + argv
+    description = '\n[*] Runs ' + ', '.join(COLLECT_ALL) + ' at the same time in one process.\n' \
+                  '[*] Every table and queue is scanned, the logs are collected incrementally.\n' \
+                  '[*] If a bucket is provided, the results are uploaded to the bucket. \n\n'
+    optional_params = [['-b', '--bucketName', 'Specify the name of the bucket.'],
+                       ['-s', '--skip', 'Comma separated scanners to skip, e.g. rolepolicies,cloudwatch.'],
+                       ['-w', '--workers', 'Number of workers of every scanner. Default value: 8.'],
+                       ['-t', '--time', 'Specify the number of hours to read the logs until the current time. '
+                                        'Default value: 24 hours.'],
+                       ['-l', '--maxMessages', 'Maximum number of messages saved per queue, 0 means no limit. '
+                                               'Default value: 100.'],
+                       ['-p', '--peek', 'Make every SQS message visible again right after it is saved.',
+                        {'action': 'store_true'}]] + common.SHARD_PARAMS + common.POOL_PARAMS
+    args = common.parsing(description, optional_params=optional_params)
+
+    skip = args['skip'].split(',') if args['skip'] else []
+    unknown = [name for name in skip if name not in COLLECT_ALL]
+    if unknown:
+        print('Invalid scanner: {}'.format(', '.join(unknown)))
+        sys.exit()
+
+    args['workers'] = int(args['workers'] or 8)
+    config_success, data = common.load_config_json("conf.json")
+    max_pool_connections = common.pool_size(args)
+
+    def _client(service):
+        # every scanner gets the shared client of the service
+        return common.create_client(config_success, data, service, max_pool_connections)
+
+    tasks = [name for name in COLLECT_ALL if name not in skip]
+    if timing:
+        report_startup('collect-all', STARTUP_BUDGET['command'])
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(tasks) or 1) as executor:
+        futures = [(name, executor.submit(_run_task, COLLECTORS[name], args, _client)) for name in tasks]
+        results = [(name, future.result()) for name, future in futures]
+
+    filenames = []
+    values = []
+    for name, (status, task_filenames, elapsed) in results:
+        filenames += task_filenames
+        values.append([name, status, len(task_filenames), '{:.1f}'.format(elapsed)])
+    print('\nCollected everything in {:.1f}s.'.format(time.time() - start))
+    common.print_table(values, ['Scanner', 'Status', 'Files', 'Seconds'])
+    common.print_throttling()
+
+    if args['bucketName']:
+        _, s3_client = _client('s3')
+        common.bucket_upload(args['bucketName'], s3_client, filenames)
+
+
+def _run_task(collector, args, client):
+    start = time.time()
+    try:
+        filenames = collector(args, client)
+        status = 'done'
+    except (Exception, SystemExit) as e:
+        # the scripts exit on errors, that only stops this scanner
+        print('{} failed: {}'.format(collector.__name__[len('collect_'):], str(e) or 'exited'))
+        filenames = []
+        status = 'failed'
+    return status, filenames, time.time() - start
+
+
+def collect_resource(args, client):
+    import common
+    import resource
+    cache = common.create_cache({})
+    values = resource.enum_resources(sorted(resource.DEFAULT_SERVICES), None, args['workers'] * 2, cache)
+    cache.close()
+    print('\nAvailable resources: \n')
+    common.print_table(values, ["Service", "Region", "Type", "Name"])
+    return []
+
+
+def collect_rolepolicies(args, client):
+    import common
+    import rolepolicies
+    access_key, secret_key, token = common.init_keys()
+    rolepolicies.policy_enumerate({'check': None, 'target': None, 'queries': None, 'context': None,
+                                   'refresh': False, 'cacheTtl': None}, access_key, secret_key, token)
+    return []
+
+
+def collect_dynamodb(args, client):
+    import common
+    import dynamodb
+    dynamo, _ = client('dynamodb')
+    tables = [table for page in dynamo.get_paginator('list_tables').paginate() for table in page['TableNames']]
+    filenames = []
+    for table in tables:
+        table_filenames, _ = dynamodb.parallel_scan(table, dynamo, args['workers'], args['workers'],
+                                                    common.writer_options(args))
+        filenames += table_filenames
+    return filenames
+
+
+def collect_sqs(args, client):
+    import common
+    import sqs
+    sqs_client, _ = client('sqs')
+    max_messages = int(args['maxMessages']) if args['maxMessages'] is not None else 100
+    filenames, _ = sqs.sweep(sqs_client, args['workers'], budget_args={'max_messages': max_messages or None},
+                             peek=args['peek'], writer_options=common.writer_options(args))
+    return filenames
+
+
+def collect_cloudwatch(args, client):
+    import common
+    import cloudwatch
+    logs_client, _ = client('logs')
+    stop_time = int(time.time()) * 1000
+    start_time = stop_time - int(args['time'] or 24) * 3600 * 1000
+    output = common.writer_options(args)
+    output['max_records'] = int(args['shardRecords']) if args['shardRecords'] else None
+    output['ndjson'] = False
+    state = cloudwatch.load_state()
+    filenames, values = cloudwatch.list_and_save(logs_client, start_time, stop_time, args['workers'], state, output)
+    cloudwatch.save_state(state)
+    cloudwatch.print_table(values)
+    return filenames
+
+
+COLLECTORS = {'resource': collect_resource, 'rolepolicies': collect_rolepolicies, 'dynamodb': collect_dynamodb,
+              'sqs': collect_sqs, 'cloudwatch': collect_cloudwatch}
+
+
+def main():
+    try:
+        args = parse()
+    except SystemExit:
+        # -h/--help exits from the parser
+        if '--timing' in sys.argv[1:2]:
+            report_startup('help', STARTUP_BUDGET['help'])
+        raise
+
+    if args['command'] == 'collect-all':
+        collect_all(args['args'], args['timing'])
+    else:
+        run_command(args['command'], args['args'], args['timing'])
+
+
+if __name__ == '__main__':
+    main()
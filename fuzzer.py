@@ -1,11 +1,29 @@
 from __future__ import print_function
 import json
-import re
-import boto3
 from kitty.model import String, Delimiter
-import ast
 import common
 import sys
+import time
+import random
+import itertools
+import collections
+import hashlib
+import os
+import tempfile
+import asyncio
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from queue import Queue
+
+# the batch APIs accept 10 entries with at most 256KB payload in total
+MAX_BATCH_SIZE = 256 * 1024
+SHUFFLE_WINDOW = 10000
+CORPUS_DIRECTORY = 'fuzz_corpus'
+# messages buffered per sink between the generator and the senders
+FAN_OUT_QUEUE = 1000
+
+_static_fuzz_cache = []
 
 
 def init():
@@ -14,115 +32,519 @@ def init():
     config_success, data = common.load_config_json("conf.json", sqs=True)
 
     if not config_success:
-        aws_access_key_id = "N/A"
-        aws_secret_access_key = "N/A"
-        aws_session_token = "N/A"
-        region_name = "N/A"
+        aws_access_key_id = None
+        aws_secret_access_key = None
+        aws_session_token = None
+        region_name = None
         fuzz_endpoint_url = ""
         message_to_fuzz = {}
 
     else:
         aws_access_key_id, aws_secret_access_key, aws_session_token, region_name, fuzz_endpoint_url, message_to_fuzz = data
 
-    sqs_client = boto3.resource('sqs',
-                                aws_access_key_id=aws_access_key_id or None,
-                                aws_secret_access_key=aws_secret_access_key or None,
-                                aws_session_token=aws_session_token or None,
-                                region_name=region_name or None,
-                                endpoint_url=fuzz_endpoint_url or None)
+    credentials = (aws_access_key_id, aws_secret_access_key, aws_session_token)
+
+    return credentials, region_name or None, fuzz_endpoint_url or None, message_to_fuzz
+
+
+def _static_fuzz_strings():
+    # the class libraries do not depend on the fuzzed value, they are computed only once
+    if not _static_fuzz_cache:
+        _static_fuzz_cache.extend(_decode(s[0]) for s in String("")._get_class_lib())
+        _static_fuzz_cache.extend(_decode(d[0]) for d in Delimiter("")._get_class_lib())
+    return _static_fuzz_cache
+
+
+def _dynamic_fuzz_strings(value):
+    fuzz_strings = []
+    fuzz_strings.extend([_decode(s[0]) for s in String(value)._get_local_lib()])
+    fuzz_strings.extend([_decode(s[0]) for s in Delimiter(value)._get_local_lib()])
+    return fuzz_strings
 
-    return sqs_client, message_to_fuzz
 
+def _decode(mutation):
+    # kitty returns bytes on python 3, latin-1 keeps every byte value
+    if isinstance(mutation, bytes):
+        return mutation.decode('latin-1')
+    return mutation
 
-def create_fuzz_messages(default_message, size=None):
-    """Creates fuzzy messages by the controller's default message
+
+def create_fuzz_messages(default_message, size=None, limit=None, shuffle=False, seed=None):
+    """Yields fuzzy messages by the controller's default message
     by changing the #value# formatted parts in it.
     :param string default_message: the controller's default_message
     :param int size: Defines the max length of the mutated string
-    :return: list
+    :param int limit: Maximum number of messages
+    :param bool shuffle: Shuffle the messages within a window of SHUFFLE_WINDOW messages
+    :param int seed: Seed of the shuffle
+    :return: generator
     """
 
-    def _static_fuzz_strings():
-        fuzz_strings = []
-        fuzz_strings.extend([s[0] for s in String("")._get_class_lib()])
-        fuzz_strings.extend([d[0] for d in Delimiter("")._get_class_lib()])
-        return fuzz_strings
-
-    def _dynamic_fuzz_strings(value):
-        fuzz_strings = []
-        fuzz_strings.extend([s[0] for s in String(value)._get_local_lib()])
-        fuzz_strings.extend([s[0] for s in Delimiter(value)._get_local_lib()])
-        return fuzz_strings
-
     marker = "#"
     pieces = default_message.split(marker)
-    static_fuzz_strings = _static_fuzz_strings()
 
     if not len(pieces) % 2:
         print('Not even number of marker found ({}), skipping default message: {}'.format(pieces, default_message))
 
-    fuzzme_list = []
-    prev_part_was_marker = False
-    fuzzme_list.extend(pieces[1::2])
-    response_list = []
-
-    # issue tests for each fuzzme string
-    for fuzzme in fuzzme_list:
-        for part in re.split(r'(\W)', default_message):
-            # fuzzable strings are surrounded with markers
-            if part == marker:
-                if prev_part_was_marker:
-                    prev_part_was_marker = False
-                else:
-                    prev_part_was_marker = True
-            # fuzz the current string
-            elif prev_part_was_marker and part == fuzzme:
-                for mutation in static_fuzz_strings + _dynamic_fuzz_strings(part):
-                    # we have to avoid to replace the marker character in the mutated part!!!
-                    marked_part = marker + part + marker
-                    other_parts = [p.replace(marker, "") for p in default_message.split(marked_part)]
-                    response_list.append(mutation.join(other_parts))
-    return response_list
-
-
-def generate_sqs_message_mutations(sqs_message):
-    sqs_message = str(sqs_message).replace("u'", "'")
-    sqs_message = str(sqs_message).replace("'", "\"")
-    sqs_message = ast.literal_eval(sqs_message)
-    sqs_msg = sqs_message
-    out_msg = dict()
-    for key, value in sqs_msg.items():
-        if isinstance(value, str):
-            out_msg["#{}#".format(key)] = "#{}#".format(value)
-        else:
-            out_msg[key] = value
-    return create_fuzz_messages(json.dumps(out_msg))
-
-
-def fuzz(sqs_client, queue_name, sqs_message):
+    # split the template only once for every fuzzable string
+    templates = []
+    for fuzzme in pieces[1::2]:
+        if fuzzme and fuzzme not in [t[0] for t in templates]:
+            # we have to avoid to replace the marker character in the mutated part!!!
+            marked_part = marker + fuzzme + marker
+            templates.append((fuzzme, [p.replace(marker, "") for p in default_message.split(marked_part)]))
 
-    try:
-        queue = sqs_client.create_queue(QueueName=queue_name)
+    def _messages():
+        for fuzzme, other_parts in templates:
+            for mutation in _static_fuzz_strings() + _dynamic_fuzz_strings(fuzzme):
+                if size:
+                    mutation = mutation[:size]
+                yield mutation.join(other_parts)
+
+    return _select(_messages(), limit, shuffle, seed)
+
+
+def _select(messages, limit=None, shuffle=False, seed=None):
+    # drops the duplicates, then shuffles and limits the message stream
+    def _unique():
+        # only the digests are kept, the messages can be up to 256KB each
+        seen = set()
+        for message in messages:
+            digest = hashlib.sha256(message.encode('utf-8')).digest()
+            if digest not in seen:
+                seen.add(digest)
+                yield message
+
+    selected = _unique()
+    if shuffle:
+        selected = _shuffled(selected, random.Random(seed))
+    return itertools.islice(selected, limit)
+
+
+def _shuffled(messages, rnd, window=SHUFFLE_WINDOW):
+    buffer = []
+    for message in messages:
+        if len(buffer) < window:
+            buffer.append(message)
+            continue
+        index = rnd.randrange(window)
+        yield buffer[index]
+        buffer[index] = message
+    rnd.shuffle(buffer)
+    for message in buffer:
+        yield message
+
+
+def json_targets(value, path=()):
+    """Yields the fuzzable parts of a JSON document: (path, value, is_key) for every
+    object key and every scalar value, also inside nested objects and arrays.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield path + (key,), key, True
+            for target in json_targets(item, path + (key,)):
+                yield target
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            for target in json_targets(item, path + (index,)):
+                yield target
+    else:
+        yield path, value, False
+
+
+def set_target(message, path, value, is_key=False):
+    """Returns a copy of message with the value (or the key) at path replaced."""
+    if not path:
+        return value
+    head = path[0]
+    if isinstance(message, dict):
+        if is_key and len(path) == 1:
+            return dict((value if key == head else key, item) for key, item in message.items())
+        copy = dict(message)
+    else:
+        copy = list(message)
+    copy[head] = set_target(message[head], path[1:], value, is_key)
+    return copy
 
-    except Exception as e:
-        print(e)
-        sys.exit()
 
-    print('Generate messages for the queue {}'.format(queue_name))
-    messages = generate_sqs_message_mutations(sqs_message)
-    counter = 0
+def _unmark(value, marker="#"):
+    if isinstance(value, str) and len(value) > 1 and value.startswith(marker) and value.endswith(marker):
+        return value[1:-1], True
+    return value, False
+
+
+def _unmark_document(value):
+    if isinstance(value, dict):
+        return dict((_unmark(key)[0], _unmark_document(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_unmark_document(item) for item in value]
+    return _unmark(value)[0]
+
+
+def mutate_targets(job):
+    """Creates the mutations of a group of targets, the same mutation is used for every target
+    of the group. Runs in the worker processes.
+    """
+    message, targets, size = job
+    value = targets[0][1]
+    text = value if isinstance(value, str) else json.dumps(value)
+    mutations = _static_fuzz_strings() + _dynamic_fuzz_strings(text)
+
+    results = []
+    for mutation in mutations:
+        if size:
+            mutation = mutation[:size]
+        mutated = message
+        for path, value, is_key in targets:
+            mutated = set_target(mutated, path, mutation, is_key)
+        results.append(json.dumps(mutated))
+    return results
+
+
+def bounded_map(executor, function, items, window):
+    # Like executor.map, but items are submitted lazily and at most window results wait for the consumer,
+    # so a slow consumer does not pile up every result in memory.
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def generate_sqs_message_mutations(sqs_message, fields=1, processes=None, corpus=CORPUS_DIRECTORY, size=None,
+                                   **kwargs):
+    """Mutates the keys and values of the JSON message, also the nested ones.
+    If any key or value is marked as #value#, only the marked ones are mutated.
+    :param sqs_message: the message as a dict, a JSON string or a text template with #marked# parts
+    :param int fields: Number of fields mutated at the same time, every combination is used
+    :param int processes: Number of processes generating the mutations
+    :param string corpus: Directory of the generated messages, keyed by the template's hash
+    :return: generator
+    """
+    if isinstance(sqs_message, str):
+        try:
+            sqs_message = json.loads(sqs_message)
+        except ValueError:
+            # plain text messages are templates, only their #marked# parts are mutated
+            return create_fuzz_messages(sqs_message, size=size, **kwargs)
+
+    targets = []
+    for path, value, is_key in json_targets(sqs_message):
+        value, marked = _unmark(value)
+        targets.append((tuple(_unmark(p)[0] for p in path), value, is_key, marked))
+    if any(target[3] for target in targets):
+        targets = [target for target in targets if target[3]]
+    # values are replaced before keys and inner keys before outer ones, so the paths stay valid
+    targets = sorted([target[:3] for target in targets], key=lambda target: (target[2], -len(target[0])))
+    message = _unmark_document(sqs_message)
+
+    key = hashlib.sha256(json.dumps([sqs_message, fields, size], sort_keys=True).encode('utf-8')).hexdigest()
+    file_name = os.path.join(corpus, key + '.ndjson')
+
+    def _generate():
+        # the mutations are sent while they are written, the corpus is only kept if it is complete
+        print('Generating the mutations of {} fields into {}'.format(len(targets), file_name))
+        if not os.path.exists(corpus):
+            os.makedirs(corpus)
+        jobs = ((message, list(group), size) for group in itertools.combinations(targets, fields))
+        # every sink generates its own stream, they must not write the same temporary file
+        fd, tmp_name = tempfile.mkstemp(dir=corpus, prefix=key + '.', suffix='.tmp', text=True)
+        executor = ProcessPoolExecutor(max_workers=processes) if processes and processes > 1 else None
+        complete = False
+        try:
+            with os.fdopen(fd, 'w') as f:
+                results_stream = bounded_map(executor, mutate_targets, jobs, 2 * processes) if executor \
+                    else map(mutate_targets, jobs)
+                for results in results_stream:
+                    for result in results:
+                        f.write(json.dumps(result) + '\n')
+                        yield result
+            complete = True
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            if complete:
+                os.replace(tmp_name, file_name)
+            else:
+                os.remove(tmp_name)
+
+    def _corpus():
+        with open(file_name, 'r') as f:
+            for line in f:
+                yield json.loads(line)
+
+    return _select(_corpus() if os.path.exists(file_name) else _generate(), **kwargs)
+
+
+def pack_batches(messages, max_entries=10, max_size=MAX_BATCH_SIZE):
+    # Groups the messages into batches of at most max_entries entries and max_size bytes in total.
+    batch = []
+    size = 0
     for msg in messages:
+        msg_size = len(msg.encode('utf-8'))
+        if batch and (len(batch) >= max_entries or size + msg_size > max_size):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(msg)
+        size += msg_size
+    if batch:
+        yield batch
+
+
+class Sink(object):
+    # A fuzz target. send(batch) delivers a batch of messages and returns the ones that failed,
+    # at most concurrency batches are sent at the same time, reusing the sink's connections.
+
+    batch_entries = 1
+
+    def __init__(self, name, concurrency=4, rate=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.limiter = common.RateLimiter(rate)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.sent = 0
+        self.failed = []
+        self.elapsed = 0
+
+    def batches(self, messages):
+        return pack_batches(messages, self.batch_entries)
+
+    def deliver(self, batch):
+        self.limiter.acquire(len(batch))
+        start = time.time()
         try:
-            queue.send_message(MessageBody=msg)
-            counter += 1
-            print("Fuzzing expression #" + str(counter) + ": " + str(msg[:40]) + "  ...  " + str(msg[-40:]))
-        except:
-            print('Failed message: {}'.format(msg))
+            failed = self.send(batch)
+        except Exception as e:
+            print('[{}] Failed batch: {}'.format(self.name, e))
+            failed = batch
+        latency = time.time() - start
+        with self.lock:
+            self.latencies.append(latency)
+            self.sent += len(batch) - len(failed)
+            self.failed += failed
 
+    def send(self, batch):
+        raise NotImplementedError
 
-if __name__ == "__main__":
-    sqs, message = init()
+    def report(self):
+        print('[{}] Sent {} messages, {} failed in {:.1f}s ({:.1f} messages/sec).'.format(
+            self.name, self.sent, len(self.failed), self.elapsed, self.sent / max(self.elapsed, 0.001)))
+        print('[{}] Send latency: p50 {:.0f} ms, p99 {:.0f} ms.'.format(
+            self.name, percentile(self.latencies, 50) * 1000, percentile(self.latencies, 99) * 1000))
+
+
+class SqsSink(Sink):
+    batch_entries = 10
+
+    def __init__(self, credentials, region, queue_name, endpoint_url=None, concurrency=4, rate=None, retries=3):
+        Sink.__init__(self, 'sqs:' + queue_name, concurrency, rate)
+        self.client = common.client_pool.client('sqs', region, credentials, endpoint_url, concurrency)
+        self.retries = retries
+        try:
+            self.queue_url = self.client.create_queue(QueueName=queue_name)['QueueUrl']
+        except Exception as e:
+            print(e)
+            sys.exit()
+
+    def send(self, batch):
+        # the failed entries which are not the sender's fault are sent again
+        entries = dict((str(n), msg) for n, msg in enumerate(batch))
+        failed = []
+        for attempt in range(self.retries):
+            if attempt:
+                # the retry is spaced out with full jitter and takes its share of the rate again
+                time.sleep(random.uniform(0, min(common.MAX_BACKOFF, 0.1 * 2 ** attempt)))
+                self.limiter.acquire(len(entries))
+            response = common.with_backoff(self.client.send_message_batch, QueueUrl=self.queue_url,
+                                           Entries=[{'Id': key, 'MessageBody': msg} for key, msg in entries.items()])
+            failed += [entries[entry['Id']] for entry in response.get('Failed', []) if entry.get('SenderFault')]
+            entries = dict((entry['Id'], entries[entry['Id']]) for entry in response.get('Failed', [])
+                           if not entry.get('SenderFault'))
+            if not entries:
+                break
+        return failed + list(entries.values())
+
+
+class SnsSink(Sink):
+
+    def __init__(self, credentials, region, topic_arn, endpoint_url=None, concurrency=4, rate=None):
+        Sink.__init__(self, 'sns:' + topic_arn, concurrency, rate)
+        self.client = common.client_pool.client('sns', region, credentials, endpoint_url, concurrency)
+        self.topic_arn = topic_arn
+        # publish_batch is missing from older botocore versions
+        if hasattr(self.client, 'publish_batch'):
+            self.batch_entries = 10
+
+    def send(self, batch):
+        if self.batch_entries == 1:
+            common.with_backoff(self.client.publish, TopicArn=self.topic_arn, Message=batch[0])
+            return []
+        entries = [{'Id': str(n), 'Message': msg} for n, msg in enumerate(batch)]
+        response = common.with_backoff(self.client.publish_batch, TopicArn=self.topic_arn,
+                                       PublishBatchRequestEntries=entries)
+        return [batch[int(entry['Id'])] for entry in response.get('Failed', [])]
+
+
+class LambdaSink(Sink):
+
+    def __init__(self, credentials, region, function_name, endpoint_url=None, concurrency=4, rate=None):
+        Sink.__init__(self, 'lambda:' + function_name, concurrency, rate)
+        self.client = common.client_pool.client('lambda', region, credentials, endpoint_url, concurrency)
+        self.function_name = function_name
+
+    def send(self, batch):
+        # asynchronous invocation, the function's result is not waited for
+        common.with_backoff(self.client.invoke, FunctionName=self.function_name, InvocationType='Event',
+                            Payload=batch[0].encode('utf-8'))
+        return []
+
+
+class HttpSink(Sink):
+
+    def __init__(self, url, concurrency=4, rate=None, timeout=10):
+        Sink.__init__(self, url, concurrency, rate)
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send(self, batch):
+        response = self.session.post(self.url, data=batch[0].encode('utf-8'), timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        # 4xx and 5xx answers are counted as failed messages
+        return batch if response.status_code >= 400 else []
+
+
+def create_sink(target, credentials=None, region=None, endpoint_url=None, concurrency=4, rate=None):
+    """Creates the sink of a target given as sqs:<QueueName>, sns:<TopicArn>,
+    lambda:<FunctionName> or an http(s):// url.
+    """
+    if target.startswith('http://') or target.startswith('https://'):
+        return HttpSink(target, concurrency, rate)
+
+    kind, _, name = target.partition(':')
+    sinks = {'sqs': SqsSink, 'sns': SnsSink, 'lambda': LambdaSink}
+    if kind not in sinks or not name:
+        print('Invalid target: {}. Use sqs:<QueueName>, sns:<TopicArn>, lambda:<FunctionName> or an url.'.format(target))
+        sys.exit()
+    return sinks[kind](credentials, region, name, endpoint_url, concurrency, rate)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def _fan_out(messages, queues):
+    # Runs in a thread: the mutation stream is generated once and every message is put to the queue of every
+    # sink, a full queue holds the generation back until the slowest sink catches up.
+    try:
+        for message in messages:
+            for messages_queue in queues:
+                messages_queue.put(message)
+    finally:
+        for messages_queue in queues:
+            messages_queue.put(None)
+
+
+def _drain(messages_queue):
+    while True:
+        message = messages_queue.get()
+        if message is None:
+            return
+        yield message
+
+
+async def _run_sink(loop, sink, messages, feeder):
+    semaphore = asyncio.Semaphore(sink.concurrency)
+    pending = set()
+    start = time.time()
+    batches = sink.batches(messages)
+    with ThreadPoolExecutor(max_workers=sink.concurrency) as executor:
+        while True:
+            # waiting for the next batch blocks, it must not stall the other sinks on the event loop
+            batch = await loop.run_in_executor(feeder, next, batches, None)
+            if batch is None:
+                break
+            await semaphore.acquire()
+            future = loop.run_in_executor(executor, sink.deliver, batch)
+            future.add_done_callback(lambda f: semaphore.release())
+            pending = set(f for f in pending if not f.done())
+            pending.add(future)
+        await asyncio.gather(*pending)
+    sink.elapsed = time.time() - start
+
+
+def dispatch(sinks, messages):
+    """Pushes the mutation stream to every sink at the same time on an asyncio event loop.
+    The stream is generated once in a separate thread and fanned out to the sinks.
+    :param list sinks: the targets
+    :param messages: the mutation stream
+    """
+    queues = [Queue(maxsize=FAN_OUT_QUEUE) for _ in sinks]
+
+    async def _run_all():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=len(sinks) + 1) as feeder:
+            await asyncio.gather(loop.run_in_executor(feeder, _fan_out, messages, queues),
+                                 *[_run_sink(loop, sink, _drain(messages_queue), feeder)
+                                   for sink, messages_queue in zip(sinks, queues)])
+
+    asyncio.run(_run_all())
+
+
+def fuzz(sinks, sqs_message, **mutation_options):
+
+    print('Generate messages for {}'.format(', '.join(sink.name for sink in sinks)))
+    dispatch(sinks, generate_sqs_message_mutations(sqs_message, **mutation_options))
+
+    for sink in sinks:
+        for msg in sink.failed:
+            print('[{}] Failed message: {}'.format(sink.name, str(msg[:40]) + "  ...  " + str(msg[-40:])))
+        sink.report()
+
+
+def main():
+    args = common.parsing('\n[*] Fuzzer for SQS queues, SNS topics, Lambda functions and HTTP endpoints.\n'
+                          '[*] Sends the mutations of the configured sqs_message to every target.\n'
+                          '[*] Every key and value is mutated, or only the #marked# ones if there are any.\n'
+                          '[*] The mutations are saved to $currentpath/fuzz_corpus and reused for the same message.\n'
+                          '[*] Default target: sqs:mrupdater-notifs\n\n',
+                          optional_params=[['-t', '--target', 'Target as sqs:<QueueName>, sns:<TopicArn>, '
+                                                              'lambda:<FunctionName> or an url. Can be repeated.',
+                                            {'action': 'append'}],
+                                           ['-x', '--endpointUrl', 'Endpoint url of the AWS targets, '
+                                                                   'e.g. a local stand-in.'],
+                                           ['-w', '--workers', 'Number of concurrent senders per target. '
+                                                               'Default value: 4.'],
+                                           ['-r', '--rate', 'Maximum number of messages sent per second per target.'],
+                                           ['-l', '--limit', 'Maximum number of messages sent.'],
+                                           ['-s', '--shuffle', 'Send the messages in random order.',
+                                            {'action': 'store_true'}],
+                                           ['-e', '--seed', 'Seed of the random order, to repeat a run.'],
+                                           ['-f', '--fields', 'Number of fields mutated at the same time. '
+                                                              'Default value: 1.'],
+                                           ['-c', '--processes', 'Number of processes generating the mutations.']])
+    credentials, region, endpoint_url, message = init()
+    workers = int(args['workers'] or 4)
+    rate = float(args['rate']) if args['rate'] else None
+    sinks = [create_sink(target, credentials, region, args['endpointUrl'] or endpoint_url, workers, rate)
+             for target in args['target'] or ['sqs:mrupdater-notifs']]
 
     print("\n\n")
     print("Fuzzing...\n\n")
-    fuzz(sqs, 'mrupdater-notifs', message)
+    fuzz(sinks, message, limit=int(args['limit']) if args['limit'] else None, shuffle=args['shuffle'],
+         seed=int(args['seed']) if args['seed'] else None, fields=int(args['fields'] or 1),
+         processes=int(args['processes']) if args['processes'] else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,9 @@
-import boto3
-import json
-import requests
 import argparse
 from argparse import RawTextHelpFormatter
 from botocore.exceptions import ClientError
 from common import load_config_json
 from common import print_table
+import common
 
 
 parser = argparse.ArgumentParser(description='[*] Lambda function uploader.\n'
@@ -16,19 +14,18 @@ required = parser.add_argument_group('required arguments')
 required.add_argument('-f', '--fileName', help='The name of the zip file containing your deployment package.', required=True)
 required.add_argument('-func', '--functionName', help='The name you want to assign to the function you are uploading.', required=True)
 required.add_argument('-r', '--runTime', help='The runtime environment for the Lambda function you are uploading. E.g.: python2.7', required=True)
+common.add_cache_params(parser)
 args = vars(parser.parse_args())
 
 
 def init():
-    # If the config file cannot be loaded then boto3 will use its cached data because the global variables contain nonesens ("N/A")
-    config_parsing_was_successful, region_name_for_logs = load_config_json("conf.json")
+    # If the config file cannot be loaded then boto3 will use the region of the aws config file
+    config_parsing_was_successful, data = load_config_json("conf.json")
 
-    if not config_parsing_was_successful:
-        region_name_for_logs = "N/A"
+    region_name_for_logs = data[3] if config_parsing_was_successful else None
 
-    lambda_client = boto3.client('lambda', region_name=region_name_for_logs)
-    r = requests.get('http://169.254.169.254/latest/meta-data/iam/info')
-    role_arn = json.loads(r.text)['InstanceProfileArn']
+    lambda_client = common.client_pool.client('lambda', region_name_for_logs)
+    role_arn = common.metadata_client().iam_info()['InstanceProfileArn']
 
     return lambda_client, role_arn
 
@@ -48,6 +45,7 @@ def list_functions(lambda_client):
 
 
 def create_run_function(lambda_client, role_arn):
+    # Returns True if the function was created.
 
     role_arn_mod = ':'.join(role_arn.split(':')[:5]) + ':role/' + role_arn.split('/')[1]
 
@@ -57,6 +55,7 @@ def create_run_function(lambda_client, role_arn):
     except Exception as e:
         print('Commandline specified file could not be loaded: {}'.format(e))
 
+    created = False
     try:
         lambda_client.create_function(
           FunctionName=args['functionName'],
@@ -66,6 +65,7 @@ def create_run_function(lambda_client, role_arn):
           Code={'ZipFile': zipped_code}
         )
         print('\nThe new Lambda function is uploaded.')
+        created = True
 
     except ClientError as ce:
         if ce.response['Error']['Code'] == 'InvalidParameterValueException':
@@ -77,13 +77,20 @@ def create_run_function(lambda_client, role_arn):
     except Exception as e:
         print(e)
 
+    return created
+
 
 def main():
     lambda_client, role_arn = init()
-    values = list_functions(lambda_client)
+    cache = common.create_cache(args)
+    identity = cache.identity(common.client_pool.session())
+    values = cache.cached(identity, lambda_client.meta.region_name, 'lambda', 'functions', list_functions, lambda_client)
     print('\nThe existing functions in Lambda:')
     print_table(values, ['FunctionName', 'Runtime', 'Description'])
-    create_run_function(lambda_client, role_arn)
+    if create_run_function(lambda_client, role_arn):
+        # the next run has to list the new function too
+        cache.delete(identity, lambda_client.meta.region_name, 'lambda', 'functions')
+    cache.close()
 
 
 if __name__ == '__main__':
@@ -1,68 +1,135 @@
 import skew
 from skew.arn import ARN
 import sys
+import time
 import argparse
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import common
 from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
 
+SERVICES = ['dynamodb', 'ec2', 'iam', 'lambda', 'logs', 's3', 'sns', 'sqs']
+DEFAULT_SERVICES = ['dynamodb', 's3', 'sqs']
 
-def init():
-    common.init_keys()
 
+def init():
     parser = argparse.ArgumentParser(
         description='\n[*] List of available resources.\n'
-                    '[*] The results can be filtered by the name of the service. Default value: [dynamodb, s3, sqs]',
+                    '[*] The results can be filtered by the name of the service. '
+                    'Default value: [' + ', '.join(DEFAULT_SERVICES) + ']\n'
+                    '[*] Every service is enumerated in every region at the same time.',
         formatter_class=RawTextHelpFormatter)
-    parser.add_argument('-s', '--service', help='Filter the type of services by choosing from {dynamodb, s3, sqs}. At '
-                                                'a time, only one service can be used for filtering.', required=False)
+    parser.add_argument('-s', '--service', help='Filter the type of services by choosing from {' + ', '.join(SERVICES) +
+                                                '}. Several services can be given separated by commas.', required=False)
+    parser.add_argument('-r', '--region', help='Only enumerate the given regions, separated by commas.',
+                        required=False)
+    parser.add_argument('-w', '--workers', help='Number of (service, region) pairs enumerated at the same time. '
+                                                'Default value: 16.', required=False)
+    common.add_cache_params(parser)
 
     args = vars(parser.parse_args())
+    common.init_keys()
 
     return args
 
 
-def enum_resources(arn, services):
-    print('Enumerating all resources in the following services: ' + ', '.join(services) + '\n')
+def service_regions(service, regions=None):
+    # The regions skew knows for the service, global services have a single empty region.
+    choices = ARN().region.choices(['arn', 'aws', service])
+    if choices == ['']:
+        return choices
+    # skew's list also holds regions that botocore does not know for the service
+    known = common.client_pool.session().get_available_regions(service)
+    return [region for region in choices if region in known and (not regions or region in regions)]
 
+
+def scan_region(service, region):
+    # Returns the [service, region, type, name] rows of the resources of a service in one region.
     values = []
+    for instance in skew.scan('arn:aws:{}:^{}$:*:*/*'.format(service, region)):
+        arn = str(instance)
+        resource = arn.split(':', 5)[5]
+        if '/' in resource:
+            resource_type, resource_name = resource.split('/', 1)
+        else:
+            # e.g. SNS topics keep their own arn
+            resource_type, resource_name = instance.resourcetype, resource
+        values.append([service, arn.split(':')[3] or 'global', resource_type, resource_name])
+    return values
 
-    for service in services:
-        arn.service.pattern = service
-        try:
-            instances = skew.scan('{}/*'.format(arn))
-            if instances:
-                for instance in instances:
-                    region = str(instance).split(':')[3]
-                    resource_name = str(instance).split('/')[1]
-                    values.append([service, region, resource_name])
-        except ClientError as error:
-            resp = error.response['Error']['Code']
-            if resp == 'ExpiredTokenException':
-                print('AWS token has expired: \n{}'.format(error))
-            else:
-                common.exception(error, 'Failed to access resource.')
-            sys.exit()
+
+def enum_resources(services, regions=None, workers=16, cache=None):
+    print('Enumerating all resources in the following services: ' + ', '.join(services) + '\n')
+
+    tasks = [(service, region) for service in services for region in service_regions(service, regions)]
+    # skew uses the default credentials
+    identity = cache.identity(common.client_pool.session()) if cache else None
+    values = []
+    timings = {}
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_timed_scan, service, region, cache, identity), (service, region))
+                       for service, region in tasks)
+        for future in as_completed(futures):
+            service, region = futures[future]
+            region_values, elapsed = future.result()
+            values += region_values
+            timing = timings.setdefault(region or 'global', [0, 0, 0.0])
+            timing[0] += 1
+            timing[1] += len(region_values)
+            timing[2] = max(timing[2], elapsed)
+            for value in region_values:
+                print('{:<10} {:<16} {:<20} {}'.format(*value))
+
+    print('\nEnumerated {} services in {} regions in {:.1f}s.'.format(len(services), len(timings), time.time() - start))
+    common.print_table([[region] + timing[:2] + ['{:.1f}'.format(timing[2])] for region, timing in timings.items()],
+                       ['Region', 'Services', 'Resources', 'Slowest service (s)'])
 
     return values
 
 
+def _timed_scan(service, region, cache=None, identity=None):
+    start = time.time()
+    try:
+        if cache:
+            values = cache.cached(identity, region, service, 'resources', scan_region, service, region)
+        else:
+            values = scan_region(service, region)
+    except ClientError as error:
+        resp = error.response['Error']['Code']
+        if resp == 'ExpiredTokenException':
+            print('AWS token has expired: \n{}'.format(error))
+            sys.exit()
+        # disabled regions and missing permissions only affect this pair
+        print('Failed to access {} in {}: {}'.format(service, region or 'global', error))
+        values = []
+    except EndpointConnectionError as error:
+        print('Failed to reach {} in {}: {}'.format(service, region or 'global', error))
+        values = []
+    return values, time.time() - start
+
+
 def main():
     args = init()
-    arn = ARN()
     if not args['service']:
-        services = ['s3', 'dynamodb', 'sqs']
-    elif args['service'] in ['s3', 'dynamodb', 'sqs']:
-        services = [args['service']]
+        services = list(DEFAULT_SERVICES)
     else:
-        print('Invalid service.')
-        sys.exit()
+        services = [service.strip() for service in args['service'].split(',')]
+        if not set(services) <= set(SERVICES):
+            print('Invalid service.')
+            sys.exit()
+
+    regions = [region.strip() for region in args['region'].split(',')] if args['region'] else None
 
     services.sort()
-    values = enum_resources(arn, services)
+    cache = common.create_cache(args)
+    values = enum_resources(services, regions, int(args['workers'] or 16), cache)
+    cache.close()
 
     print('\nAvailable resources: \n')
-    common.print_table(values, ["Service", "Region", "Name"])
+    common.print_table(values, ["Service", "Region", "Type", "Name"])
 
 
 if __name__ == '__main__':
@@ -1,16 +1,14 @@
-import boto3
-import requests
 import json
 import argparse
 from argparse import RawTextHelpFormatter
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import re
+import functools
 import common
 
 
 def init():
-    access_key, secret_key, token = common.init_keys()
-
     parser = argparse.ArgumentParser(
         description='[*] List of policies attached to the role of the instance profile.\n'
                     '[*] The results can be filtered by any of the returned attributes using regular expressions.\n'
@@ -20,7 +18,12 @@ def init():
                     '   [+] Resource: Specifies the object or objects that the statement covers.\n'
                     '   [+] Effect: Specifies whether the statement results in an allow or an explicit deny.\n'
                     '   [+] Policy name: The name of the AWS managed or inline policy.'
-                    ' \n\nExample: \n    python rolepolicies.py -s ec2 -a Desc* -r \* -e Allow -p ^Amazon',
+                    '   [+] Condition: The conditions of the statement.\n'
+                    '[*] The effective permissions can be queried with -c and -t, NotAction, NotResource, wildcards\n'
+                    '    and explicit denies are taken into account.'
+                    ' \n\nExample: \n    python rolepolicies.py -s ec2 -a Desc* -r \\* -e Allow -p ^Amazon'
+                    ' \n    python rolepolicies.py -c s3:GetObject -t arn:aws:s3:::bucket/key'
+                    ' \n    python rolepolicies.py -t arn:aws:s3:::bucket/key',
         formatter_class=RawTextHelpFormatter)
     parser.add_argument('-s', '--service', help='Regular expression filter for the Service column.', required=False)
     parser.add_argument('-a', '--action', help='Regular expression filter for the Action column.', required=False)
@@ -29,135 +32,341 @@ def init():
     parser.add_argument('-e', '--effect', help='Regular expression filter for the Effect column.', required=False)
     parser.add_argument('-p', '--policyname', help='Regular expression filter for the Policy name column.',
                         required=False)
+    parser.add_argument('-c', '--check', help='Action to check, e.g. s3:GetObject.', required=False)
+    parser.add_argument('-t', '--target', help='Resource arn to check, without -c every allowed action on it is listed.',
+                        required=False)
+    parser.add_argument('-x', '--context', help='Condition key and value used in the checks, e.g. aws:SecureTransport=true.'
+                                                ' Can be repeated.', required=False, action='append')
+    parser.add_argument('-q', '--queries', help='File with an "action resource" check on each line.', required=False)
+    common.add_cache_params(parser)
     args = vars(parser.parse_args())
+    access_key, secret_key, token = common.init_keys()
 
     return args, access_key, secret_key, token
 
 
 def policy_enumerate(args, access_key, secret_key, token):
-    session = boto3.Session(aws_access_key_id=access_key,
-                            aws_secret_access_key=secret_key,
-                            aws_session_token=token)
-    iam = session.client('iam')
-    iamres = session.resource('iam')
-
-    r = requests.get('http://169.254.169.254/latest/meta-data/iam/info')
-    role_arn = json.loads(r.text)['InstanceProfileArn']
+    session = common.client_pool.session((access_key, secret_key, token))
+    iam = common.client_pool.client('iam', None, (access_key, secret_key, token))
+
+    role_arn = common.metadata_client().iam_info()['InstanceProfileArn']
     role = role_arn.split('/')[1]
 
-    response1 = None
-    response2 = None
+    cache = common.create_cache(args)
+    statements = cache.cached(cache.identity(session), None, 'iam', 'role-statements/' + role,
+                              role_policies, iam, role)
+    cache.close()
+
+    if args['check'] or args['target'] or args['queries']:
+        query_policies(PolicyStore(statements), args)
+        return
+
+    print('\nThe following permissions belong to the role {}: \n'.format(role))
+
+    values_to_print = filter_results(table_values(statements), args)
+
+    common.print_table(values_to_print, ["Service", "Action", "Resource", "Effect", "Policy name", "Condition"])
+
+
+def query_policies(store, args):
+    context = dict(item.split('=', 1) for item in args['context'] or [])
+
+    if args['queries']:
+        try:
+            with open(args['queries'], 'r') as f:
+                queries = [line.split() for line in f if line.strip()]
+        except IOError as e:
+            print('Query file could not be loaded: {}'.format(e))
+            return
+        values = [[query[0], query[1] if len(query) > 1 else '*', store.evaluate(query[0], query[1] if len(query) > 1
+                                                                                 else None, context)]
+                  for query in queries]
+        common.print_table(values, ['Action', 'Resource', 'Decision'])
+
+    elif args['check']:
+        print('{} on {}: {}'.format(args['check'], args['target'] or '*',
+                                    store.evaluate(args['check'], args['target'], context)))
+
+    else:
+        print('\nThe following actions are allowed on {}: \n'.format(args['target']))
+        common.print_table([[action] for action in store.allowed_actions(args['target'], context)], ['Action'])
+
+
+def role_policies(iam, role, workers=8):
+    attached_policies = []
+    policy_names = []
 
     try:
-        response1 = iam.list_attached_role_policies(RoleName=role)
-        response2 = iam.list_role_policies(RoleName=role)
+        for page in iam.get_paginator('list_attached_role_policies').paginate(RoleName=role):
+            attached_policies += page['AttachedPolicies']
+        for page in iam.get_paginator('list_role_policies').paginate(RoleName=role):
+            policy_names += page['PolicyNames']
 
     except ClientError as error:
         common.exception(error, 'List role policy failed.')
 
-    print('\nThe following permissions belong to the role {}: \n'.format(role))
+    # every policy is fetched at the same time, the documents of the policy versions are cached forever
+    documents = common.Cache(ttl=None)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        attached = executor.map(lambda policy: attached_policy_enum(iam, policy['PolicyArn'], documents),
+                                attached_policies)
+        inline = executor.map(lambda policy_name: managed_policy_enum(iam, role, policy_name), policy_names)
+        values = [value for policy_values in list(attached) + list(inline) for value in policy_values]
+    documents.close()
+    return values
 
-    values = []
-    values += attached_policy_enum(iam, iamres, response1)
-    values += managed_policy_enum(iamres, response2, role)
 
-    values_to_print = filter_results(values, args)
+def attached_policy_enum(iam, policy_arn, documents):
+    try:
+        policy = common.with_backoff(iam.get_policy, PolicyArn=policy_arn)
+        version_id = policy['Policy']['DefaultVersionId']
+        # a policy version never changes, so the AWS managed policies are only downloaded once
+        document = documents.cached(('', ''), None, 'iam', '{}#{}'.format(policy_arn, version_id),
+                                    lambda: common.with_backoff(iam.get_policy_version, PolicyArn=policy_arn,
+                                                                VersionId=version_id)['PolicyVersion']['Document'])
 
-    common.print_table(values_to_print, ["Service", "Action", "Resource", "Effect", "Policy name"])
+    except ClientError as error:
+        common.exception(error, 'Get role policy failed.')
 
+    return policy_statements(document, policy_arn.split('/')[-1])
 
-def attached_policy_enum(iam, iamres, response1):
-    values = []
 
-    for attached_policy in response1['AttachedPolicies']:
-        role_policy1 = iamres.Policy(attached_policy['PolicyArn'])
+def managed_policy_enum(iam, role, policy_name):
+    try:
+        document = common.with_backoff(iam.get_role_policy, RoleName=role,
+                                       PolicyName=policy_name)['PolicyDocument']
 
-        policy_version = None
+    except ClientError as error:
+        common.exception(error, 'Get role policy failed.')
 
-        try:
-            policy = iam.get_policy(PolicyArn=role_policy1.arn)
-            policy_version = iam.get_policy_version(PolicyArn=role_policy1.arn,
-                                                    VersionId=policy['Policy']['DefaultVersionId'])
+    return policy_statements(document, policy_name)
 
-        except ClientError as error:
-            common.exception(error, 'Get role policy failed.')
 
-        for statement in policy_version['PolicyVersion']['Document']['Statement']:
-            resource = statement['Resource']
-            effect = statement['Effect']
-            actions = statement['Action']
+def policy_statements(document, name):
+    # Statement, Action and Resource can be single values or lists, they are always lists here.
+    statements = document['Statement']
+    if not isinstance(statements, list):
+        statements = [statements]
+    return [{'Policy': name, 'Effect': statement['Effect'],
+             'Action': as_list(statement.get('Action')), 'NotAction': as_list(statement.get('NotAction')),
+             'Resource': as_list(statement.get('Resource')), 'NotResource': as_list(statement.get('NotResource')),
+             'Condition': statement.get('Condition')}
+            for statement in statements]
 
-            if isinstance(actions, list):
-                for action in actions:
-                    values.append(compose_value(action, resource, effect, role_policy1.arn.split('/')[-1]))
-            else:
-                values.append(compose_value(actions, resource, effect, role_policy1.arn.split('/')[-1]))
 
-    return values
+def as_list(value):
+    if value is None:
+        return None
+    return value if isinstance(value, list) else [value]
 
 
-def managed_policy_enum(iamres, response2, role):
+def table_values(statements):
     values = []
 
-    for policy_name in response2['PolicyNames']:
-        role_policy2 = iamres.RolePolicy(role, policy_name)
-        policy_statement = role_policy2.policy_document['Statement']
-
-        for pol_stat in policy_statement:
-            resource = pol_stat['Resource']
-            effect = pol_stat['Effect']
-            actions = pol_stat['Action']
-
-            if type(actions) is list:
-                for action in actions:
-                    values.append(compose_value(action, resource, effect, role_policy2.name))
-            else:
-                values.append(compose_value(actions, resource, effect, role_policy2.name))
+    for statement in statements:
+        if statement['NotResource'] is not None:
+            resource = 'NOT ' + ', '.join(statement['NotResource'])
+        else:
+            resource = ', '.join(statement['Resource'] or [])
+        condition = json.dumps(statement['Condition'], sort_keys=True) if statement['Condition'] else ''
+
+        if statement['NotAction'] is not None:
+            for action in statement['NotAction']:
+                values.append(compose_value(action, resource, statement['Effect'], statement['Policy'], condition,
+                                            'NOT '))
+        else:
+            for action in statement['Action'] or []:
+                values.append(compose_value(action, resource, statement['Effect'], statement['Policy'], condition))
     return values
 
 
-def compose_value(action, resource, effect, name):
-    val = [action.split(':')[0], action.split(':')[1], resource, effect, name]
+def compose_value(action, resource, effect, name, condition='', prefix=''):
+    service, _, action_name = action.partition(':')
+    val = [service if action_name else '*', prefix + (action_name or service), resource, effect, name, condition]
     return val
 
 
+@functools.lru_cache(maxsize=4096)
+def wildcard(pattern, ignore_case=False):
+    # IAM wildcards: * matches any sequence of characters, ? matches a single character.
+    regex = ''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char) for char in pattern)
+    return re.compile(regex + r'\Z', re.IGNORECASE if ignore_case else 0)
+
+
+def covers(pattern, other):
+    # True if every action matching the IAM wildcard pattern other also matches pattern (case insensitive).
+    # Conservative: a * of other is only covered by a * of pattern.
+    pattern = pattern.lower()
+    other = other.lower()
+
+    @functools.lru_cache(maxsize=None)
+    def _covers(i, j):
+        if j == len(other):
+            return all(char == '*' for char in pattern[i:])
+        if i == len(pattern):
+            return False
+        if pattern[i] == '*':
+            return _covers(i + 1, j) or _covers(i, j + 1)
+        if other[j] == '*':
+            return False
+        if pattern[i] == '?' or pattern[i] == other[j]:
+            return _covers(i + 1, j + 1)
+        return False
+
+    return _covers(0, 0)
+
+
+class Statement(object):
+    # A policy statement with precompiled matchers, actions are case insensitive, resources are not.
+
+    def __init__(self, statement):
+        self.policy = statement['Policy']
+        self.effect = statement['Effect']
+        self.not_action = statement['NotAction'] is not None
+        self.action_patterns = statement['NotAction'] if self.not_action else statement['Action'] or []
+        self.actions = [wildcard(action, True) for action in self.action_patterns]
+        self.not_resource = statement['NotResource'] is not None
+        self.resources = [wildcard(resource) for resource in (statement['NotResource'] if self.not_resource
+                                                              else statement['Resource'] or [])]
+        # a statement scoped to some resources only decides an action checked without a resource
+        # if it covers every resource
+        self.any_resource = not self.not_resource and '*' in (statement['Resource'] or [])
+        self.condition = statement['Condition'] or {}
+        self.services = set(action.split(':')[0].lower() for action in self.action_patterns)
+
+    def matches_action(self, action):
+        return any(matcher.match(action) for matcher in self.actions) != self.not_action
+
+    def matches_resource(self, resource):
+        # without a resource every resource of the statement is accepted
+        if resource is None:
+            return True
+        return any(matcher.match(resource) for matcher in self.resources) != self.not_resource
+
+    def matches_condition(self, context):
+        # True or False if every condition can be evaluated with the context, otherwise None.
+        result = True
+        for operator, conditions in self.condition.items():
+            for key, expected in conditions.items():
+                outcome = evaluate_condition(operator, context.get(key), as_list(expected))
+                if outcome is False:
+                    return False
+                if outcome is None:
+                    result = None
+        return result
+
+
+def evaluate_condition(operator, value, expected):
+    if operator.endswith('IfExists'):
+        if value is None:
+            return True
+        operator = operator[:-len('IfExists')]
+    if operator == 'Null':
+        return (value is None) == (str(expected[0]).lower() == 'true')
+    if value is None:
+        return None
+
+    negate = 'Not' in operator
+    operator = operator.replace('Not', '')
+    if operator in ('StringEquals', 'ArnEquals'):
+        matched = value in expected
+    elif operator == 'StringEqualsIgnoreCase':
+        matched = value.lower() in [str(e).lower() for e in expected]
+    elif operator in ('StringLike', 'ArnLike'):
+        matched = any(wildcard(str(e)).match(value) for e in expected)
+    elif operator == 'Bool':
+        matched = value.lower() in [str(e).lower() for e in expected]
+    else:
+        # numeric, date and ip conditions are not evaluated
+        return None
+    return matched != negate
+
+
+class PolicyStore(object):
+    # The statements of the role's policies indexed by service, answering allow/deny questions:
+    # an explicit deny wins over any allow, without an allow the action is implicitly denied.
+    # Statements whose conditions cannot be decided with the given context make the answer Conditional.
+
+    def __init__(self, statements):
+        self.index = {}
+        self.wildcards = []
+        self.statements = [Statement(statement) for statement in statements]
+        for statement in self.statements:
+            if statement.not_action or any('*' in service or '?' in service for service in statement.services):
+                self.wildcards.append(statement)
+            else:
+                for service in statement.services:
+                    self.index.setdefault(service, []).append(statement)
+
+    def candidates(self, action):
+        return self.index.get(action.split(':')[0].lower(), []) + self.wildcards
+
+    def evaluate(self, action, resource=None, context=None):
+        context = context or {}
+        allowed = maybe_allowed = maybe_denied = False
+        for statement in self.candidates(action):
+            if not statement.matches_action(action) or not statement.matches_resource(resource):
+                continue
+            condition = statement.matches_condition(context)
+            if condition is False:
+                continue
+            if statement.effect == 'Deny':
+                if condition and (resource is not None or statement.any_resource):
+                    return 'Deny'
+                maybe_denied = True
+            elif condition:
+                allowed = True
+            else:
+                maybe_allowed = True
+        if allowed and not maybe_denied:
+            return 'Allow'
+        return 'Conditional' if allowed or maybe_allowed else 'ImplicitDeny'
+
+    def is_allowed(self, action, resource=None, context=None):
+        return self.evaluate(action, resource, context) == 'Allow'
+
+    def allowed_actions(self, resource, context=None):
+        # The allowed action patterns on the resource, minus the ones an unconditional Action deny covers entirely.
+        # A NotAction deny never removes a pattern, the actions it leaves out may still be allowed.
+        context = context or {}
+        denies = [pattern for statement in self.statements
+                  if statement.effect == 'Deny' and not statement.not_action and statement.matches_resource(resource)
+                  and (resource is not None or statement.any_resource) and statement.matches_condition(context)
+                  for pattern in statement.action_patterns]
+        actions = set()
+        for statement in self.statements:
+            if statement.effect != 'Allow' or not statement.matches_resource(resource) or \
+                    statement.matches_condition(context) is False:
+                continue
+            if statement.not_action:
+                actions.update('NOT ' + pattern for pattern in statement.action_patterns)
+            else:
+                actions.update(pattern for pattern in statement.action_patterns
+                               if not any(covers(deny, pattern) for deny in denies))
+        return sorted(actions)
+
+
 def filter_results(values, args):
-    values_to_print = []
+    # the regular expressions are compiled once, the action filter also keeps the wildcard actions of the
+    # services whose resources are enumerated by the other scripts
+    columns = {'service': 0, 'action': 1, 'resource': 2, 'effect': 3, 'policyname': 4}
+    filters = [(columns[key], re.compile(str(key_value))) for key, key_value in args.items()
+               if key in columns and key_value]
 
+    values_to_print = []
     for value in values:
-        match = True
-        for key, key_value in args.iteritems():
-            while match:
-                if key == 'service':
-                    match = match_function(key_value, value[0])
-                    break
-                if key == 'resource':
-                    match = match_function(key_value, value[2])
-                    break
-                if key == 'effect':
-                    match = match_function(key_value, value[3])
-                    break
-                if key == 'policyname':
-                    match = match_function(key_value, value[4])
-                    break
-                if key == 'action' and key_value and not \
-                        (re.match(str(key_value), value[1]) or
-                         (value[1] == '*' and value[0] in ["iam", "s3", "dynamodb", "lambda"])):
-                    match = False
-                break
-        if match:
+        if all(regex.match(value[column]) or
+               (column == 1 and value[1] == '*' and value[0] in ["iam", "s3", "dynamodb", "lambda"])
+               for column, regex in filters):
             values_to_print.append(value)
 
     return values_to_print
 
 
-def match_function(key_value, component):
-    if key_value and not re.match(str(key_value), component):
-        return False
-    else:
-        return True
+def main():
+    arguments, access_key_id, secret_access_key, session_token = init()
+    policy_enumerate(arguments, access_key_id, secret_access_key, session_token)
 
 
 if __name__ == '__main__':
-    arguments, access_key_id, secret_access_key, session_token = init()
-    policy_enumerate(arguments, access_key_id, secret_access_key, session_token)
+    main()
@@ -1,44 +1,334 @@
 from botocore.exceptions import ClientError
 from botocore.exceptions import EndpointConnectionError
 import common
+import re
 import sys
-import boto3
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
 
+# A peek stops when as many messages were seen as the queue held at the start, or when at least
+# PEEK_DUPLICATE_RATIO of the last PEEK_WINDOW received messages were already seen before.
+PEEK_WINDOW = 1000
+PEEK_DUPLICATE_RATIO = 0.9
 
-def scan_queue(queue_name, sqs):
-    queue = None
+
+class Budget(object):
+    # Message, byte and time limits of a scan, None means unlimited.
+
+    def __init__(self, max_messages=None, max_bytes=None, max_seconds=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.deadline = time.time() + max_seconds if max_seconds else None
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        with self.lock:
+            if self.exhausted():
+                return False
+            self.messages += 1
+            self.bytes += size
+            return True
+
+    def exhausted(self):
+        return bool((self.max_messages and self.messages >= self.max_messages) or
+                    (self.max_bytes and self.bytes >= self.max_bytes) or
+                    (self.deadline and time.time() >= self.deadline))
+
+    def wait_time(self):
+        if not self.deadline:
+            return 20
+        return int(max(0, min(20, self.deadline - time.time())))
+
+
+def get_queue_url(queue_name, client):
     try:
-        queue = sqs.create_queue(QueueName=queue_name)
+        return client.get_queue_url(QueueName=queue_name)['QueueUrl']
     except EndpointConnectionError as error:
         print('The requested queue could not be reached. \n{}'.format(error))
         sys.exit()
     except ClientError as error:
+        if error.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue':
+            print('Requested queue not found.')
+            sys.exit()
         common.exception(error, 'Queue could not be reached. \n{}'.format(error))
-    # get messages
-    msgs = []
+
+
+def list_queues(client, prefix=None, pattern=None):
+    kwargs = {'QueueNamePrefix': prefix} if prefix else {}
+    try:
+        if client.can_paginate('list_queues'):
+            # SQS only returns a NextToken when MaxResults is sent, without a page size it stops at 1000
+            pages = client.get_paginator('list_queues').paginate(PaginationConfig={'PageSize': 1000}, **kwargs)
+        else:
+            pages = [client.list_queues(**kwargs)]
+        queue_urls = [url for page in pages for url in page.get('QueueUrls', [])]
+    except EndpointConnectionError as error:
+        print('Error: {}'.format(error))
+        sys.exit()
+    except ClientError as error:
+        common.exception(error, 'List queues failed.')
+
+    if pattern:
+        regex = re.compile(pattern)
+        queue_urls = [url for url in queue_urls if regex.search(url.split('/')[-1])]
+    return queue_urls
+
+
+def get_attributes(client, queue_url):
+    try:
+        return common.with_backoff(client.get_queue_attributes, QueueUrl=queue_url,
+                                   AttributeNames=['All'])['Attributes']
+    except ClientError as error:
+        print('Queue attributes could not be read: {}, due to: {}'.format(queue_url, error))
+        return None
+
+
+class SeenMessages(object):
+    # Bounded set of the last received message ids, used to drop re-received messages.
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.ids = collections.OrderedDict()
+        self.unique = 0
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def add(self, message_id):
+        with self.lock:
+            if message_id in self.ids:
+                self.ids.move_to_end(message_id)
+                self.duplicates += 1
+                return False
+            self.ids[message_id] = True
+            self.unique += 1
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return True
+
+
+def release_messages(client, queue_url, releases, stats):
+    # Makes the captured messages visible again for the real consumers, 10 at a time.
     while True:
-        messages = queue.receive_messages(VisibilityTimeout=120, WaitTimeSeconds=20)
-        for message in messages:
-            msgs.append(message.body)
-        if not messages or len(msgs) > 100:
+        messages = releases.get()
+        if messages is None:
             break
-    return msgs
+        for i in range(0, len(messages), 10):
+            entries = [{'Id': str(n), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0}
+                       for n, message in enumerate(messages[i:i + 10])]
+            try:
+                response = common.with_backoff(client.change_message_visibility_batch, QueueUrl=queue_url,
+                                               Entries=entries)
+                stats['released'] += len(response.get('Successful', []))
+                stats['release_failed'] += len(response.get('Failed', []))
+            except ClientError as error:
+                print('Releasing messages failed: {}'.format(error))
+                stats['release_failed'] += len(entries)
+
+
+def scan_queue(queue_name, sqs, receivers=1, budget=None, stats=None, peek=False, queue_url=None):
+    # Yields the message bodies received by the receiver threads. Every receiver asks for batches of 10
+    # and stops when the queue returns no messages or the budget is exhausted.
+    # In peek mode every received message is released right away by a separate thread, so the scan does not
+    # hold back the queue's consumers. As the released messages are received again, the receivers stop when
+    # the number of distinct messages reaches the queue depth read before the scan (ApproximateNumberOfMessages),
+    # or when most of the last PEEK_WINDOW received messages are repeats, e.g. the queue is refilled meanwhile.
+    # stats is filled with the number of messages, bytes and seconds of the scan.
+
+    # the low level client is thread safe, the resource objects are not
+    client = getattr(sqs.meta, 'client', sqs)
+    queue_url = queue_url or get_queue_url(queue_name, client)
+    budget = budget or Budget(max_messages=100)
+    stats = stats if stats is not None else {}
+    stats.update({'released': 0, 'release_failed': 0})
+
+    batches = Queue(maxsize=receivers * 4)
+    releases = Queue()
+    seen = SeenMessages()
+    stop = threading.Event()
+    depth = None
+    recent = collections.deque(maxlen=PEEK_WINDOW)
+    recent_lock = threading.Lock()
+    if peek:
+        attributes = get_attributes(client, queue_url)
+        depth = int(attributes['ApproximateNumberOfMessages']) if attributes else None
+
+    def _peeked(received, new_received):
+        # True if the peek has seen the whole queue, the window holds True for every repeated message
+        with recent_lock:
+            recent.extend([False] * new_received + [True] * (received - new_received))
+            if depth is not None and seen.unique >= depth:
+                return True
+            return len(recent) == PEEK_WINDOW and sum(recent) >= PEEK_DUPLICATE_RATIO * PEEK_WINDOW
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def _receive():
+        try:
+            while not stop.is_set() and not budget.exhausted():
+                response = common.with_backoff(client.receive_message, QueueUrl=queue_url,
+                                               MaxNumberOfMessages=10, VisibilityTimeout=30 if peek else 120,
+                                               WaitTimeSeconds=budget.wait_time())
+                messages = response.get('Messages', [])
+                if not messages:
+                    break
+                if peek:
+                    releases.put(messages)
+                new_messages = [message for message in messages if seen.add(message['MessageId'])]
+                if new_messages:
+                    _put(new_messages)
+                if peek and _peeked(len(messages), len(new_messages)):
+                    break
+        except ClientError as error:
+            print('Receiving messages failed: {}'.format(error))
+        finally:
+            _put(None)
+
+    start = time.time()
+    threads = [threading.Thread(target=_receive) for _ in range(receivers)]
+    if peek:
+        releaser = threading.Thread(target=release_messages, args=(client, queue_url, releases, stats))
+        releaser.start()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    try:
+        while finished < receivers:
+            messages = batches.get()
+            if messages is None:
+                finished += 1
+                continue
+            for message in messages:
+                if not budget.take(len(message['Body'])):
+                    break
+                yield message['Body']
+    finally:
+        stop.set()
+        if peek:
+            # the receivers may still be releasing their last batch
+            for thread in threads:
+                thread.join()
+            releases.put(None)
+            releaser.join()
+        stats.update({'messages': budget.messages, 'bytes': budget.bytes, 'seconds': time.time() - start,
+                      'duplicates': seen.duplicates})
+
+
+def sweep(sqs, workers=8, prefix=None, pattern=None, budget_args=None, peek=False, writer_options=None,
+          on_close=None):
+    # Scans every reachable queue, at most workers queues at the same time with one receiver each.
+    client = getattr(sqs.meta, 'client', sqs)
+    queue_urls = list_queues(client, prefix, pattern)
+    print('Found {} queues.'.format(len(queue_urls)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        attributes = list(executor.map(lambda url: get_attributes(client, url), queue_urls))
+
+    values = []
+    queues = []
+    for queue_url, attrs in zip(queue_urls, attributes):
+        if attrs is None:
+            continue
+        queue_name = queue_url.split('/')[-1]
+        values.append([queue_name, int(attrs.get('ApproximateNumberOfMessages', 0)),
+                       int(attrs.get('ApproximateNumberOfMessagesNotVisible', 0)),
+                       attrs.get('FifoQueue', 'false')])
+        if int(attrs.get('ApproximateNumberOfMessages', 0)):
+            queues.append((queue_name, queue_url))
+
+    common.print_table(values, ['Queue', 'Messages', 'Not visible', 'FIFO'])
+
+    def _scan(queue_name, queue_url):
+        stats = {}
+        with common.ShardWriter('sqs', queue_name, on_close=on_close, **(writer_options or {})) as writer:
+            writer.write_all(scan_queue(queue_name, sqs, 1, Budget(**(budget_args or {})), stats, peek, queue_url))
+        print_stats(stats, queue_name)
+        return writer
+
+    filenames = []
+    hashes = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for writer in executor.map(lambda queue: _scan(*queue), queues):
+            filenames += writer.filenames
+            hashes.update(writer.hashes)
+
+    return filenames, hashes
+
+
+def print_stats(stats, queue_name=None):
+    prefix = '[{}] '.format(queue_name) if queue_name else ''
+    print('{}Received {} messages ({:.1f} MB) in {:.1f}s ({:.1f} messages/sec).'.format(
+        prefix, stats['messages'], stats['bytes'] / float(common.MB), stats['seconds'],
+        stats['messages'] / max(stats['seconds'], 0.001)))
+    if stats['duplicates']:
+        print('{}Dropped {} re-received messages.'.format(prefix, stats['duplicates']))
+    if stats['released'] or stats['release_failed']:
+        print('{}Released {} messages, {} could not be released.'.format(prefix, stats['released'],
+                                                                         stats['release_failed']))
 
 
 def main():
 
     description = '\n[*] SQS message scanner.\n' \
-                  '[*] Specify the name of the queue to save the messages from.\n' \
+                  '[*] Specify the name of the queue to save the messages from, or sweep all queues.\n' \
+                  '[*] By default the first 100 messages are saved, use the limits to drain the queue. \n' \
+                  '[*] In peek mode the messages are released right away and are not held back from the consumers. \n' \
                   '[*] If a bucket is provided, the results are uploaded to the bucket. \n\n'
+    optional_params = [['-r', '--receivers', 'Number of concurrent receivers. Default value: 1.'],
+                       ['-l', '--maxMessages', 'Maximum number of messages to save, 0 means no limit. '
+                                               'Default value: 100.'],
+                       ['-y', '--maxBytes', 'Maximum size of the saved messages in bytes.'],
+                       ['-s', '--maxSeconds', 'Maximum duration of the scan in seconds.'],
+                       ['-p', '--peek', 'Make every message visible again right after it is saved.',
+                        {'action': 'store_true'}],
+                       ['-e', '--sweep', 'Scan every queue that can be listed with the current credentials.',
+                        {'action': 'store_true'}],
+                       ['-g', '--queuePrefix', 'Only sweep the queues with this name prefix.'],
+                       ['-f', '--queueFilter', 'Only sweep the queues whose name matches this regular expression.'],
+                       ['-w', '--workers', 'Number of queues swept at the same time. Default value: 8.']]
+
+    args, sqs, s3_client = common.init(description, 'sqs', optional_params)
+
+    if not args['queueName'] and not args['sweep']:
+        print('Specify the name of the queue or use --sweep.')
+        sys.exit()
 
-    args, sqs, s3_client = common.init(description, 'sqs')
+    max_messages = int(args['maxMessages']) if args['maxMessages'] is not None else 100
+    budget_args = {'max_messages': max_messages or None,
+                   'max_bytes': int(args['maxBytes']) if args['maxBytes'] else None,
+                   'max_seconds': float(args['maxSeconds']) if args['maxSeconds'] else None}
 
-    data = scan_queue(str(args['queueName']), sqs)
+    uploader = common.create_uploader(args, s3_client)
+    on_close = uploader.on_close if uploader and args['uploadAsWritten'] else None
 
-    filenames = common.write_to_file_1000('sqs', str(args['queueName']), data)
+    if args['sweep']:
+        filenames, hashes = sweep(sqs, int(args['workers'] or 8), args['queuePrefix'], args['queueFilter'],
+                                  budget_args, args['peek'], common.writer_options(args), on_close)
+    else:
+        queue_name = str(args['queueName'])
+        stats = {}
+        with common.ShardWriter('sqs', queue_name, on_close=on_close, **common.writer_options(args)) as writer:
+            writer.write_all(scan_queue(queue_name, sqs, int(args['receivers'] or 1), Budget(**budget_args), stats,
+                                        args['peek']))
+        print_stats(stats)
+        filenames, hashes = writer.filenames, writer.hashes
+    common.print_throttling()
+    print('Files can be found in $currentpath/sqs_scan folder.')
 
     if args['bucketName']:
-        common.bucket_upload(args['bucket'], s3_client, filenames)
+        common.bucket_upload(args['bucketName'], s3_client, filenames, uploader, hashes)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# the scripts are top-level modules of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    # fake credentials for moto, the scanners write their output into the current directory
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_SESSION_TOKEN', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.chdir(tmp_path)
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        yield tmp_path
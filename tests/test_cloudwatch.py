@@ -0,0 +1,105 @@
+import glob
+import gzip
+import io
+import os
+import time
+
+import boto3
+import pytest
+
+import cloudwatch
+import common
+
+GROUP = '/app/api'
+NOW = int(time.time()) * 1000
+START = NOW - 3600 * 1000
+
+
+@pytest.fixture
+def logs(aws):
+    client = boto3.client('logs')
+    client.create_log_group(logGroupName=GROUP)
+    for stream in ['web', 'worker']:
+        client.create_log_stream(logGroupName=GROUP, logStreamName=stream)
+        put_events(client, stream, 0, 5)
+    return client
+
+
+def put_events(client, stream, first, count):
+    client.put_log_events(logGroupName=GROUP, logStreamName=stream,
+                          logEvents=[{'timestamp': NOW - 60000 + n, 'message': '{} event {}'.format(stream, n)}
+                                     for n in range(first, first + count)])
+
+
+def read_lines(file_name):
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    if file_name.endswith('.gz'):
+        data = gzip.decompress(data)
+    elif file_name.endswith('.zst'):
+        reader = common.zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+        data = reader.read()
+    return data.decode('utf-8').splitlines()
+
+
+def stream_lines(stream, directory='cw_logs'):
+    lines = []
+    for file_name in sorted(glob.glob(os.path.join(os.getcwd(), directory, 'appapi--{}-*'.format(stream)))):
+        lines += read_lines(file_name)
+    return lines
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'zstd'])
+def test_second_run_appends_only_the_new_events(logs, compression, capsys):
+    if compression == 'zstd' and not common.zstandard:
+        pytest.skip('zstandard is not installed')
+    output = {'compression': compression}
+    state = {}
+    cloudwatch.list_and_save(logs, START, NOW + 60000, 2, state, output)
+    assert stream_lines('web') == ['web event {}'.format(n) for n in range(5)]
+    assert state[GROUP]['web']['timestamp'] == NOW - 60000 + 4
+
+    put_events(logs, 'web', 5, 3)
+    capsys.readouterr()
+    filenames, _ = cloudwatch.list_and_save(logs, START, NOW + 60000, 2, state, output)
+
+    assert 'Skipped 1 streams without new events.' in capsys.readouterr().out
+    assert [os.path.basename(name).split('-')[2] for name in filenames] == ['web']
+    assert stream_lines('web') == ['web event {}'.format(n) for n in range(8)]
+    assert stream_lines('worker') == ['worker event {}'.format(n) for n in range(5)]
+    assert state[GROUP]['web']['timestamp'] == NOW - 60000 + 7
+
+
+def test_state_is_saved_between_runs(logs):
+    state = cloudwatch.load_state()
+    cloudwatch.list_and_save(logs, START, NOW + 60000, 2, state)
+    cloudwatch.save_state(state)
+
+    assert cloudwatch.load_state() == state
+    assert sorted(cloudwatch.load_state()[GROUP]) == ['web', 'worker']
+
+
+def test_invalid_token_falls_back_to_the_timestamp(logs):
+    state = {}
+    cloudwatch.list_and_save(logs, START, NOW + 60000, 2, state)
+    state[GROUP]['web']['token'] = 'f/expired'
+    put_events(logs, 'web', 5, 2)
+
+    cloudwatch.list_and_save(logs, START, NOW + 60000, 2, state)
+
+    assert stream_lines('web') == ['web event {}'.format(n) for n in range(7)]
+    assert state[GROUP]['web']['token'] != 'f/expired'
+    assert state[GROUP]['web']['timestamp'] == NOW - 60000 + 6
+
+
+def test_filtered_events_are_kept_apart(logs):
+    cloudwatch.list_and_save(logs, START, NOW + 60000, 2, {})
+
+    filenames, values = cloudwatch.filter_and_save(logs, START, NOW + 60000, 'web', workers=2)
+
+    assert values == {GROUP}
+    assert filenames and all(os.path.dirname(name) == os.path.join(os.getcwd(), 'cw_logs', 'filtered')
+                             for name in filenames)
+    assert stream_lines('web', os.path.join('cw_logs', 'filtered')) == ['web event {}'.format(n) for n in range(5)]
+    # the incremental shards are not touched
+    assert stream_lines('web') == ['web event {}'.format(n) for n in range(5)]
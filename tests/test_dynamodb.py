@@ -0,0 +1,176 @@
+import glob
+import json
+import os
+import time
+
+import boto3
+import pytest
+
+import dynamodb
+
+ITEMS = 100
+
+
+@pytest.fixture
+def table(aws):
+    client = boto3.client('dynamodb')
+    client.create_table(TableName='items', KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+                        BillingMode='PAY_PER_REQUEST')
+    for i in range(ITEMS):
+        client.put_item(TableName='items', Item={'id': {'S': 'item{:03d}'.format(i)}, 'n': {'N': str(i)}})
+    return client
+
+
+class FailingClient(object):
+    # Fails the scan after the given number of pages, like an interrupted export.
+
+    def __init__(self, client, pages):
+        self.client = client
+        self.pages = pages
+
+    def scan(self, **kwargs):
+        if self.pages <= 0:
+            raise RuntimeError('interrupted')
+        self.pages -= 1
+        return self.client.scan(**kwargs)
+
+
+def shards():
+    return sorted(glob.glob(os.path.join(os.getcwd(), 'dynamodb_scan', '*.ndjson')))
+
+
+def saved_ids():
+    ids = []
+    for file_name in shards():
+        with open(file_name) as f:
+            ids += [json.loads(line)['id']['S'] for line in f]
+    return ids
+
+
+def test_segmented_scan_writes_every_item_once(table):
+    filenames, hashes = dynamodb.parallel_scan('items', table, 4, writer_options={'max_records': 10},
+                                               scan_options={'Limit': 10})
+
+    ids = saved_ids()
+    assert len(ids) == ITEMS
+    assert set(ids) == set('item{:03d}'.format(i) for i in range(ITEMS))
+    assert sorted(filenames) == shards()
+    assert set(hashes) == set(filenames)
+    assert not glob.glob('dynamodb_scan/*.checkpoint')
+
+
+def test_interrupted_scan_resumes_from_checkpoint(table):
+    with pytest.raises(RuntimeError):
+        dynamodb.parallel_scan('items', FailingClient(table, 3), 2, workers=1,
+                               writer_options={'max_records': 10}, scan_options={'Limit': 10})
+    assert glob.glob('dynamodb_scan/items.checkpoint')
+    interrupted = len(saved_ids())
+    assert 0 < interrupted < ITEMS
+
+    dynamodb.parallel_scan('items', table, 2, writer_options={'max_records': 10}, scan_options={'Limit': 10})
+
+    ids = saved_ids()
+    assert len(ids) == ITEMS
+    assert len(set(ids)) == ITEMS
+    assert not glob.glob('dynamodb_scan/*.checkpoint')
+
+
+def test_checkpoint_of_other_segment_count_is_ignored(aws):
+    dynamodb.Checkpoint('items', 2).update(0, {'id': {'S': 'item050'}}, 50, 6, ['a.ndjson'])
+
+    assert dynamodb.Checkpoint('items', 2).get(0) == ({'id': {'S': 'item050'}}, 50, 6, ['a.ndjson'], False)
+    assert dynamodb.Checkpoint('items', 4).get(0) == (None, 0, 1, [], False)
+
+
+PROVISIONED = {'BillingModeSummary': {'BillingMode': 'PROVISIONED'},
+               'ProvisionedThroughput': {'ReadCapacityUnits': 400, 'WriteCapacityUnits': 5}}
+ON_DEMAND = {'BillingModeSummary': {'BillingMode': 'PAY_PER_REQUEST'},
+             'ProvisionedThroughput': {'ReadCapacityUnits': 0, 'WriteCapacityUnits': 0}}
+
+
+@pytest.mark.parametrize('description, expected', [
+    (PROVISIONED, 400),
+    # a table created before billing modes were reported is provisioned
+    ({'ProvisionedThroughput': {'ReadCapacityUnits': 25}}, 25),
+    (dict(ON_DEMAND, OnDemandThroughput={'MaxReadRequestUnits': 1500}), 1500),
+    (dict(ON_DEMAND, OnDemandThroughput={'MaxReadRequestUnits': -1}, WarmThroughput={'ReadUnitsPerSecond': 30000}),
+     30000),
+    (dict(ON_DEMAND, OnDemandThroughput={'MaxReadRequestUnits': -1}), dynamodb.ON_DEMAND_RCU),
+    (ON_DEMAND, 12000),
+])
+def test_read_capacity(description, expected):
+    assert dynamodb.read_capacity(description) == expected
+
+
+@pytest.mark.parametrize('max_rcu, rcu_percent, expected', [
+    (None, None, None),
+    (None, 25, 100),
+    (50, None, 50),
+    (50, 25, 50),
+    (500, 25, 100),
+])
+def test_capacity_target(max_rcu, rcu_percent, expected):
+    assert dynamodb.capacity_target(PROVISIONED, max_rcu, rcu_percent) == expected
+
+
+def test_page_limit():
+    # 1KB items cost 0.125 RCU when read eventually consistent and 0.25 RCU when read consistently
+    description = {'ItemCount': 1000, 'TableSizeBytes': 1024 * 1000}
+
+    assert dynamodb.page_limit(description, 100, 4) == 200
+    assert dynamodb.page_limit(description, 100, 4, consistent_read=True) == 100
+    assert dynamodb.page_limit(description, 0.01, 4) == 1
+    # the size of an empty or new table is not known yet
+    assert dynamodb.page_limit({'ItemCount': 0, 'TableSizeBytes': 0}, 100, 4) is None
+
+
+def test_projection_always_reads_the_keys():
+    description = {'KeySchema': [{'AttributeName': 'pk', 'KeyType': 'HASH'}, {'AttributeName': 'sk', 'KeyType': 'RANGE'}]}
+
+    assert dynamodb.projection('name, sk,', description) == {
+        'ProjectionExpression': '#p0, #p1, #p2',
+        'ExpressionAttributeNames': {'#p0': 'name', '#p1': 'sk', '#p2': 'pk'}}
+
+
+def test_capacity_limiter_waits_for_the_consumed_units():
+    limiter = dynamodb.CapacityLimiter(10)
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start < 0.05
+
+    limiter.consume(5)
+    limiter.acquire()
+
+    assert 0.4 < time.time() - start < 0.7
+    assert limiter.consumed == 5
+
+
+class CapacityClient(object):
+    # Scan stand-in: every segment has the given number of pages, each page reports units of consumed capacity.
+
+    def __init__(self, pages, units):
+        self.pages = pages
+        self.units = units
+
+    def scan(self, Segment=0, ExclusiveStartKey=None, **kwargs):
+        page = int(ExclusiveStartKey['id']['S'].split('-')[1]) + 1 if ExclusiveStartKey else 0
+        key = {'id': {'S': '{}-{}'.format(Segment, page)}}
+        response = {'Items': [key], 'ConsumedCapacity': {'CapacityUnits': self.units}}
+        if page + 1 < self.pages:
+            response['LastEvaluatedKey'] = key
+        return response
+
+
+def test_scan_holds_the_capacity_target(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    capacity = dynamodb.CapacityLimiter(200)
+
+    start = time.time()
+    filenames, _ = dynamodb.parallel_scan('items', CapacityClient(50, 5), 2, capacity=capacity)
+    elapsed = time.time() - start
+
+    assert capacity.consumed == 2 * 50 * 5
+    # at most one page per worker above the target
+    assert 200 * 0.8 < capacity.consumed / elapsed < 200 * 1.1
+    assert len(saved_ids()) == 100
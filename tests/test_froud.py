@@ -0,0 +1,72 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+import froud
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(*args):
+    # the output and the wall-clock time of the fastest of three runs, so a busy machine does not fail the test
+    runs = []
+    for _ in range(3):
+        start = time.time()
+        output = subprocess.run([sys.executable, os.path.join(ROOT, 'froud.py')] + list(args), cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+        runs.append((time.time() - start, output))
+    elapsed, output = min(runs)
+    return output, elapsed
+
+
+# the process start time of /proc is rounded to clock ticks
+TICK = 0.01
+
+
+def startup_time(output, name):
+    match = re.search(r'\[timing\] {} started in ([0-9.]+)s'.format(name), output)
+    assert match, output
+    return float(match.group(1))
+
+
+def test_help_is_within_the_startup_budget():
+    output, elapsed = run('--timing', '-h')
+
+    for name, _ in froud.COMMANDS:
+        assert name in output
+    assert startup_time(output, 'help') <= elapsed + TICK
+    assert elapsed <= froud.STARTUP_BUDGET['help']
+
+
+@pytest.mark.parametrize('command', ['sqs', 'dynamodb', 'fuzzer'])
+def test_command_is_within_the_startup_budget(command):
+    output, elapsed = run('--timing', command, '-h')
+
+    assert startup_time(output, command) <= elapsed + TICK
+    assert elapsed <= froud.STARTUP_BUDGET['command']
+
+
+def test_runner_does_not_import_the_scanners():
+    code = 'import sys, froud; print(sorted(set(sys.modules) & {"boto3", "prettytable", "requests", "kitty", "common"}))'
+
+    assert subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, universal_newlines=True).strip() == '[]'
+
+
+def test_unknown_command_fails():
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.check_output([sys.executable, os.path.join(ROOT, 'froud.py'), 'ec2'], cwd=ROOT,
+                                stderr=subprocess.STDOUT)
+
+
+def test_failed_scanner_is_reported(capsys):
+    def collect_sqs(args, client):
+        raise SystemExit()
+
+    status, filenames, _ = froud._run_task(collect_sqs, {}, None)
+
+    assert (status, filenames) == ('failed', [])
+    assert capsys.readouterr().out == 'sqs failed: exited\n'
@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import pytest
+
+import fuzzer
+
+CREDENTIALS = ('testing', 'testing', 'testing')
+MESSAGE = {'id': '#1#', 'body': {'text': 'hello', 'count': 1}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Records the posted bodies, the /error path answers 500.
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        with self.server.lock:
+            self.server.bodies.append(body)
+        self.send_response(500 if self.path == '/error' else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.bodies = []
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path='/'):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+def receive_all(client, queue_url):
+    bodies = []
+    while True:
+        messages = client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10,
+                                          WaitTimeSeconds=0).get('Messages', [])
+        if not messages:
+            return bodies
+        bodies += [message['Body'] for message in messages]
+
+
+def test_mutations_are_cached_in_the_corpus(aws):
+    mutations = list(fuzzer.generate_sqs_message_mutations(MESSAGE))
+
+    assert len(os.listdir(fuzzer.CORPUS_DIRECTORY)) == 1
+    assert list(fuzzer.generate_sqs_message_mutations(MESSAGE)) == mutations
+    assert len(set(mutations)) == len(mutations)
+    # only the marked value is mutated
+    assert all(json.loads(message)['body'] == MESSAGE['body'] for message in mutations)
+
+
+def test_interrupted_generation_leaves_no_corpus(aws):
+    assert len(list(fuzzer.generate_sqs_message_mutations(MESSAGE, limit=5))) == 5
+
+    assert os.listdir(fuzzer.CORPUS_DIRECTORY) == []
+
+
+def test_process_pool_generates_the_same_mutations(aws):
+    mutations = list(fuzzer.generate_sqs_message_mutations(MESSAGE, corpus='single', fields=2))
+
+    assert list(fuzzer.generate_sqs_message_mutations(MESSAGE, corpus='pool', fields=2, processes=2)) == mutations
+
+
+def test_bounded_map_keeps_a_window_of_pending_calls():
+    submitted = []
+
+    def _items():
+        for i in range(100):
+            submitted.append(i)
+            yield i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = fuzzer.bounded_map(executor, lambda i: i * 2, _items(), 4)
+        assert [next(results) for _ in range(3)] == [0, 2, 4]
+        assert len(submitted) <= 3 + 4
+        assert list(results) == [i * 2 for i in range(3, 100)]
+
+
+def test_text_template_mutates_the_marked_part(aws):
+    messages = list(fuzzer.generate_sqs_message_mutations('name=#value#&id=1', limit=10))
+
+    assert len(messages) == 10
+    assert all(message.startswith('name=') and message.endswith('&id=1') for message in messages)
+
+
+def test_pack_batches_respects_entries_and_size():
+    batches = list(fuzzer.pack_batches(['a' * 100] * 25, max_entries=10, max_size=450))
+
+    assert [len(batch) for batch in batches] == [4, 4, 4, 4, 4, 4, 1]
+
+
+def test_same_mutations_reach_every_sink(aws, server):
+    sqs = boto3.client('sqs')
+    sns = boto3.client('sns')
+    queue_url = sqs.create_queue(QueueName='fuzzed')['QueueUrl']
+    topic_queue_url = sqs.create_queue(QueueName='topic-subscriber')['QueueUrl']
+    topic_arn = sns.create_topic(Name='fuzzed')['TopicArn']
+    queue_arn = sqs.get_queue_attributes(QueueUrl=topic_queue_url, AttributeNames=['QueueArn'])
+    sns.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn['Attributes']['QueueArn'],
+                  Attributes={'RawMessageDelivery': 'true'})
+
+    sinks = [fuzzer.create_sink(target, CREDENTIALS, 'us-east-1')
+             for target in ['sqs:fuzzed', 'sns:' + topic_arn, url(server)]]
+    fuzzer.fuzz(sinks, MESSAGE, limit=25)
+
+    expected = sorted(fuzzer.generate_sqs_message_mutations(MESSAGE, limit=25))
+    assert sorted(receive_all(sqs, queue_url)) == expected
+    assert sorted(receive_all(sqs, topic_queue_url)) == expected
+    assert sorted(server.bodies) == expected
+    for sink in sinks:
+        assert sink.sent == 25 and sink.failed == []
+
+
+class ListSink(fuzzer.Sink):
+    # Keeps the sent messages.
+
+    batch_entries = 3
+
+    def __init__(self, name):
+        fuzzer.Sink.__init__(self, name, concurrency=2)
+        self.messages = []
+
+    def send(self, batch):
+        with self.lock:
+            self.messages += batch
+        return []
+
+
+def test_mutations_are_generated_once_for_every_sink(aws, monkeypatch):
+    calls = []
+    mutate_targets = fuzzer.mutate_targets
+
+    def _mutate_targets(job):
+        calls.append(job)
+        return mutate_targets(job)
+
+    monkeypatch.setattr(fuzzer, 'mutate_targets', _mutate_targets)
+    sinks = [ListSink('first'), ListSink('second'), ListSink('third')]
+
+    fuzzer.fuzz(sinks, MESSAGE)
+
+    # a single job for the single marked field
+    assert len(calls) == 1
+    assert len(os.listdir(fuzzer.CORPUS_DIRECTORY)) == 1
+    expected = list(fuzzer.generate_sqs_message_mutations(MESSAGE))
+    for sink in sinks:
+        assert sorted(sink.messages) == sorted(expected)
+
+
+class FlakyQueue(object):
+    # send_message_batch fails the first entry with a server side error the given number of times.
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append([entry['MessageBody'] for entry in Entries])
+        if self.failures:
+            self.failures -= 1
+            return {'Failed': [{'Id': Entries[0]['Id'], 'SenderFault': False, 'Code': 'InternalError'}]}
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+class CountingLimiter(object):
+
+    def __init__(self):
+        self.units = []
+
+    def acquire(self, units=1):
+        self.units.append(units)
+
+
+def test_sqs_retries_are_delayed_and_rate_limited(aws, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(fuzzer.time, 'sleep', sleeps.append)
+    sink = fuzzer.create_sink('sqs:fuzzed', CREDENTIALS, 'us-east-1')
+    sink.client = FlakyQueue(2)
+    sink.limiter = CountingLimiter()
+
+    sink.deliver(['a', 'b', 'c'])
+
+    assert sink.client.calls == [['a', 'b', 'c'], ['a'], ['a']]
+    assert sink.limiter.units == [3, 1, 1]
+    assert len(sleeps) == 2
+    assert (sink.sent, sink.failed) == (3, [])
+
+
+def test_sqs_gives_up_after_the_retries(aws, monkeypatch):
+    monkeypatch.setattr(fuzzer.time, 'sleep', lambda seconds: None)
+    sink = fuzzer.create_sink('sqs:fuzzed', CREDENTIALS, 'us-east-1')
+    sink.client = FlakyQueue(5)
+
+    sink.deliver(['a', 'b'])
+
+    assert (sink.sent, sink.failed) == (1, ['a'])
+
+
+def test_http_errors_are_failed_messages(aws, server):
+    sink = fuzzer.create_sink(url(server, '/error'), concurrency=2)
+
+    fuzzer.fuzz([sink], MESSAGE, limit=5)
+
+    assert sink.sent == 0
+    assert len(sink.failed) == 5
+    assert len(server.bodies) == 5
+
+
+def test_invalid_target_exits():
+    with pytest.raises(SystemExit):
+        fuzzer.create_sink('kinesis:stream')
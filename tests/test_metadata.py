@@ -0,0 +1,182 @@
+import json
+import os
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import common
+
+ROLE = 'scanner-role'
+
+
+def credentials(lifetime):
+    expiration = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + lifetime))
+    return {'AccessKeyId': 'ASIAFAKE', 'SecretAccessKey': 'secret', 'Token': 'token', 'Expiration': expiration}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Instance metadata service stand-in. With server.imdsv1 the token endpoint is missing,
+    # otherwise every request needs the current session token.
+
+    def _answer(self, status, body=''):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        self.server.requests.append(('PUT', self.path))
+        if self.server.put_delay:
+            # the reply is lost, e.g. dropped by the hop limit in a container
+            time.sleep(self.server.put_delay)
+        if self.server.imdsv1:
+            return self._answer(404)
+        self.server.tokens += 1
+        self._answer(200, 'token{}'.format(self.server.tokens))
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))
+        token = self.headers.get('X-aws-ec2-metadata-token')
+        if not self.server.imdsv1 and token != 'token{}'.format(self.server.tokens):
+            return self._answer(401)
+        pages = {'/latest/meta-data/iam/info': json.dumps({'InstanceProfileArn': 'arn:aws:iam::123456789012:'
+                                                                                 'instance-profile/' + ROLE}),
+                 '/latest/meta-data/iam/security-credentials/': ROLE,
+                 '/latest/meta-data/iam/security-credentials/' + ROLE: json.dumps(self.server.credentials)}
+        if self.path not in pages:
+            return self._answer(404)
+        self._answer(200, pages[self.path])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def imds():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.imdsv1 = False
+    httpd.put_delay = 0
+    httpd.tokens = 0
+    httpd.requests = []
+    httpd.credentials = credentials(3600)
+    httpd.url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def credential_requests(server):
+    return len([request for request in server.requests if request[1].endswith(ROLE)])
+
+
+def test_credentials_are_cached_until_they_expire(imds):
+    client = common.MetadataClient(imds.url)
+
+    assert client.role_credentials() == imds.credentials
+    assert client.role_credentials() == imds.credentials
+    assert credential_requests(imds) == 1
+    assert imds.tokens == 1
+
+
+def test_expiring_credentials_are_renewed(imds):
+    imds.credentials = credentials(common.IMDS_REFRESH - 10)
+    client = common.MetadataClient(imds.url)
+
+    client.role_credentials()
+    client.role_credentials()
+
+    assert credential_requests(imds) == 2
+
+
+def test_rejected_token_is_renewed(imds):
+    client = common.MetadataClient(imds.url)
+    client.iam_info()
+    # the token is rotated on the server side
+    imds.tokens += 1
+
+    assert client.role_credentials()['AccessKeyId'] == 'ASIAFAKE'
+    assert len([request for request in imds.requests if request[0] == 'PUT']) == 2
+
+
+def token_requests(server):
+    return len([request for request in server.requests if request[0] == 'PUT'])
+
+
+def test_imdsv1_fallback(imds):
+    imds.imdsv1 = True
+    client = common.MetadataClient(imds.url)
+
+    assert client.iam_info()['InstanceProfileArn'].endswith('/' + ROLE)
+    assert client.role_credentials() == imds.credentials
+    # the token is only asked for once
+    assert token_requests(imds) == 1
+
+
+def test_lost_token_reply_costs_a_single_timeout(imds):
+    imds.imdsv1 = True
+    imds.put_delay = 1
+    client = common.MetadataClient(imds.url, timeout=0.3)
+
+    start = time.time()
+    client.iam_info()
+    client.role_credentials()
+
+    assert time.time() - start < 0.6
+    assert token_requests(imds) == 1
+
+
+def test_rejected_imdsv1_request_retries_imdsv2(imds):
+    imds.imdsv1 = True
+    client = common.MetadataClient(imds.url)
+    client.iam_info()
+    # IMDSv2 is required from now on
+    imds.imdsv1 = False
+
+    assert client.role_credentials() == imds.credentials
+    assert token_requests(imds) == 2
+
+
+def test_imdsv2_is_tried_again_after_the_fallback_expires(imds, monkeypatch):
+    imds.imdsv1 = True
+    client = common.MetadataClient(imds.url)
+    client.iam_info()
+    monkeypatch.setattr(common, 'IMDS_FALLBACK', 0)
+    client.fallback_expiry = 0
+
+    client.role_credentials()
+
+    assert token_requests(imds) == 3
+
+
+def test_unreachable_service_exits():
+    client = common.MetadataClient('http://127.0.0.1:1', timeout=0.5)
+
+    with pytest.raises(SystemExit):
+        client.role_credentials()
+
+
+def test_disk_cache_is_private_and_reused(imds, tmp_path):
+    cache_file = str(tmp_path / 'froud' / 'imds_credentials.json')
+    common.MetadataClient(imds.url, cache_file=cache_file).role_credentials()
+
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(os.path.dirname(cache_file)).st_mode) == 0o700
+    assert common.MetadataClient(imds.url, cache_file=cache_file).role_credentials() == imds.credentials
+    assert credential_requests(imds) == 1
+
+
+def test_disk_cache_is_opt_in(monkeypatch):
+    monkeypatch.setattr(common, '_metadata_client', None)
+    monkeypatch.delenv(common.IMDS_CACHE_VARIABLE, raising=False)
+    assert common.metadata_client().cache_file is None
+
+    monkeypatch.setattr(common, '_metadata_client', None)
+    monkeypatch.setenv(common.IMDS_CACHE_VARIABLE, '1')
+    assert common.metadata_client().cache_file == common.IMDS_CACHE_FILE
@@ -0,0 +1,122 @@
+import pytest
+
+import rolepolicies
+
+BUCKET = 'arn:aws:s3:::reports'
+OBJECT = 'arn:aws:s3:::reports/2024/summary.csv'
+
+
+def store(*statements):
+    return rolepolicies.PolicyStore(rolepolicies.policy_statements({'Statement': list(statements)}, 'policy'))
+
+
+def test_explicit_deny_beats_allow():
+    policies = store({'Effect': 'Allow', 'Action': 's3:*', 'Resource': '*'},
+                     {'Effect': 'Deny', 'Action': 's3:DeleteObject', 'Resource': 'arn:aws:s3:::reports/*'})
+
+    assert policies.evaluate('s3:DeleteObject', OBJECT) == 'Deny'
+    assert policies.evaluate('s3:DeleteObject', 'arn:aws:s3:::other/key') == 'Allow'
+    assert policies.evaluate('s3:GetObject', OBJECT) == 'Allow'
+    assert policies.evaluate('sqs:SendMessage', OBJECT) == 'ImplicitDeny'
+    assert not policies.is_allowed('s3:DeleteObject', OBJECT)
+
+
+def test_not_action_and_not_resource():
+    policies = store({'Effect': 'Allow', 'NotAction': 'iam:*', 'Resource': '*'},
+                     {'Effect': 'Deny', 'Action': 's3:*', 'NotResource': ['arn:aws:s3:::reports', 'arn:aws:s3:::reports/*']})
+
+    assert policies.evaluate('iam:CreateUser', '*') == 'ImplicitDeny'
+    assert policies.evaluate('sqs:SendMessage', 'arn:aws:sqs:us-east-1:123456789012:queue') == 'Allow'
+    assert policies.evaluate('s3:GetObject', OBJECT) == 'Allow'
+    assert policies.evaluate('s3:GetObject', 'arn:aws:s3:::other/key') == 'Deny'
+
+
+@pytest.mark.parametrize('action, resource, expected', [
+    ('s3:GetObject', OBJECT, 'Allow'),
+    ('S3:getobject', OBJECT, 'Allow'),
+    ('s3:GetObjectAcl', OBJECT, 'Allow'),
+    ('s3:PutObject', OBJECT, 'ImplicitDeny'),
+    ('s3:GetObject', 'arn:aws:s3:::reports/2024/summary.xlsx', 'ImplicitDeny'),
+    ('s3:GetObject', 'arn:aws:s3:::REPORTS/2024/summary.csv', 'ImplicitDeny'),
+    ('dynamodb:Query', 'arn:aws:dynamodb:us-east-1:123456789012:table/orders', 'Allow'),
+    ('dynamodb:Query', 'arn:aws:dynamodb:us-east-1:123456789012:table/orders2', 'ImplicitDeny'),
+])
+def test_wildcards(action, resource, expected):
+    # * matches any sequence and ? a single character, actions are case insensitive and resources are not
+    policies = store({'Effect': 'Allow', 'Action': 's3:GetObject*', 'Resource': 'arn:aws:s3:::reports/*/*.csv'},
+                     {'Effect': 'Allow', 'Action': 'dynamodb:Q?ery', 'Resource': 'arn:aws:dynamodb:*:*:table/orders'})
+
+    assert policies.evaluate(action, resource) == expected
+
+
+def test_undecided_conditions_are_conditional():
+    policies = store({'Effect': 'Allow', 'Action': 's3:GetObject', 'Resource': '*',
+                      'Condition': {'StringEquals': {'aws:PrincipalTag/team': 'data'}}},
+                     {'Effect': 'Allow', 'Action': 's3:PutObject', 'Resource': '*'},
+                     {'Effect': 'Deny', 'Action': 's3:PutObject', 'Resource': '*',
+                      'Condition': {'IpAddress': {'aws:SourceIp': '10.0.0.0/8'}}})
+
+    assert policies.evaluate('s3:GetObject', OBJECT) == 'Conditional'
+    assert policies.evaluate('s3:GetObject', OBJECT, {'aws:PrincipalTag/team': 'data'}) == 'Allow'
+    assert policies.evaluate('s3:GetObject', OBJECT, {'aws:PrincipalTag/team': 'web'}) == 'ImplicitDeny'
+    # ip conditions are not evaluated, the deny may apply
+    assert policies.evaluate('s3:PutObject', OBJECT, {'aws:SourceIp': '10.1.2.3'}) == 'Conditional'
+
+
+@pytest.mark.parametrize('operator, value, expected, result', [
+    ('StringEquals', 'data', ['data'], True),
+    ('StringNotEquals', 'data', ['data'], False),
+    ('StringEqualsIgnoreCase', 'DATA', ['data'], True),
+    ('StringLike', 'arn:aws:iam::123456789012:role/scanner', ['arn:aws:iam::*:role/scan*'], True),
+    ('Bool', 'True', ['true'], True),
+    ('Null', None, ['true'], True),
+    ('StringEqualsIfExists', None, ['data'], True),
+    ('StringEquals', None, ['data'], None),
+    ('NumericLessThan', '5', ['10'], None),
+])
+def test_evaluate_condition(operator, value, expected, result):
+    assert rolepolicies.evaluate_condition(operator, value, expected) == result
+
+
+def test_resource_scoped_deny_without_resource():
+    policies = store({'Effect': 'Allow', 'Action': 's3:*', 'Resource': '*'},
+                     {'Effect': 'Deny', 'Action': 's3:GetObject', 'NotResource': 'arn:aws:s3:::public/*'},
+                     {'Effect': 'Deny', 'Action': 's3:PutObject', 'Resource': 'arn:aws:s3:::reports/*'},
+                     {'Effect': 'Deny', 'Action': 's3:DeleteBucket', 'Resource': '*'})
+
+    assert policies.evaluate('s3:GetObject') == 'Conditional'
+    assert policies.evaluate('s3:PutObject') == 'Conditional'
+    assert policies.evaluate('s3:DeleteBucket') == 'Deny'
+    assert policies.evaluate('s3:ListBucket') == 'Allow'
+
+
+def test_allowed_actions_keeps_patterns_of_not_action_denies():
+    policies = store({'Effect': 'Allow', 'Action': 's3:Get*', 'Resource': '*'},
+                     {'Effect': 'Deny', 'NotAction': 's3:GetObject', 'Resource': '*'})
+
+    assert policies.evaluate('s3:GetObject', OBJECT) == 'Allow'
+    assert policies.evaluate('s3:GetObjectAcl', OBJECT) == 'Deny'
+    assert policies.allowed_actions(OBJECT) == ['s3:Get*']
+
+
+def test_allowed_actions_drops_covered_patterns():
+    policies = store({'Effect': 'Allow', 'Action': ['s3:Get*', 's3:PutObject', 'sqs:*'], 'Resource': '*'},
+                     {'Effect': 'Deny', 'Action': ['s3:Put*', 'sqs:Send*'], 'Resource': '*'},
+                     {'Effect': 'Deny', 'Action': 's3:*', 'Resource': '*',
+                      'Condition': {'StringEquals': {'aws:PrincipalTag/team': 'web'}}})
+
+    assert policies.allowed_actions(OBJECT) == ['s3:Get*', 'sqs:*']
+    assert policies.allowed_actions(OBJECT, {'aws:PrincipalTag/team': 'web'}) == ['sqs:*']
+
+
+@pytest.mark.parametrize('pattern, other, result', [
+    ('s3:*', 's3:Get*', True),
+    ('s3:Get*', 's3:*', False),
+    ('s3:GetO?', 's3:GetO*', False),
+    ('s3:Get?bject', 's3:GetObject', True),
+    ('S3:GETOBJECT', 's3:GetObject', True),
+    ('s3:*Object', 's3:Get*Object', True),
+    ('s3:GetObject', 's3:Get?bject', False),
+])
+def test_covers(pattern, other, result):
+    assert rolepolicies.covers(pattern, other) == result
@@ -0,0 +1,81 @@
+import json
+
+import boto3
+import pytest
+
+import sqs
+
+
+@pytest.fixture
+def client(aws):
+    return boto3.client('sqs')
+
+
+def create_queue(client, name, messages):
+    queue_url = client.create_queue(QueueName=name)['QueueUrl']
+    for i in range(0, messages, 10):
+        client.send_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(n), 'MessageBody': json.dumps({'queue': name, 'n': n})} for n in range(i, min(i + 10, messages))])
+    return queue_url
+
+
+def queue_depth(client, queue_url):
+    attributes = sqs.get_attributes(client, queue_url)
+    return int(attributes['ApproximateNumberOfMessages']), int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+
+def test_drain_receives_every_message_once(client):
+    queue_url = create_queue(client, 'orders', 45)
+    stats = {}
+
+    # the deadline ends the long polling of the empty queue
+    bodies = list(sqs.scan_queue('orders', client, 3, sqs.Budget(max_seconds=3), stats, queue_url=queue_url))
+
+    # moto can hand the same message to two concurrent receivers, the duplicate is dropped
+    assert sorted(json.loads(body)['n'] for body in bodies) == list(range(45))
+    assert stats['messages'] == 45
+    assert queue_depth(client, queue_url) == (0, 45)
+
+
+def test_drain_stops_at_the_message_limit(client):
+    queue_url = create_queue(client, 'orders', 45)
+
+    bodies = list(sqs.scan_queue('orders', client, 2, sqs.Budget(max_messages=20), queue_url=queue_url))
+
+    assert len(bodies) == 20
+    assert len(set(bodies)) == 20
+
+
+def test_peek_releases_the_messages(client):
+    queue_url = create_queue(client, 'orders', 10)
+    stats = {}
+
+    bodies = list(sqs.scan_queue('orders', client, 1, sqs.Budget(max_seconds=10), stats, peek=True,
+                                 queue_url=queue_url))
+
+    assert sorted(json.loads(body)['n'] for body in bodies) == list(range(10))
+    assert stats['released'] == 10 and stats['release_failed'] == 0
+    # the whole queue was seen, the peek did not wait for the deadline
+    assert stats['seconds'] < 5
+    assert queue_depth(client, queue_url) == (10, 0)
+
+
+def test_sweep_scans_the_queues_with_messages(client):
+    create_queue(client, 'orders', 15)
+    create_queue(client, 'payments', 5)
+    create_queue(client, 'empty', 0)
+
+    filenames, hashes = sqs.sweep(client, 2, budget_args={'max_seconds': 3})
+
+    assert sorted(name.split('/')[-1] for name in filenames) == ['orders-00001.ndjson', 'payments-00001.ndjson']
+    assert set(hashes) == set(filenames)
+    with open([name for name in filenames if 'orders' in name][0]) as f:
+        assert len(f.readlines()) == 15
+
+
+def test_list_queues_filters_by_prefix_and_pattern(client):
+    for name in ['orders', 'orders-dlq', 'payments']:
+        create_queue(client, name, 0)
+
+    assert [url.split('/')[-1] for url in sqs.list_queues(client, 'orders')] == ['orders', 'orders-dlq']
+    assert [url.split('/')[-1] for url in sqs.list_queues(client, pattern='dlq$')] == ['orders-dlq']
@@ -0,0 +1,81 @@
+import json
+import os
+
+import boto3
+import pytest
+
+import common
+
+BUCKET = 'froud-results'
+
+
+@pytest.fixture
+def s3(aws):
+    client = boto3.client('s3')
+    client.create_bucket(Bucket=BUCKET)
+    return client
+
+
+@pytest.fixture
+def shards(aws):
+    directory = common.scan_directory('sqs')
+    filenames = []
+    for i in range(6):
+        file_name = os.path.join(directory, 'queue-{:05d}.ndjson'.format(i + 1))
+        with open(file_name, 'w') as f:
+            f.write('{"Body": "message %d"}\n' % i)
+        filenames.append(file_name)
+    return filenames
+
+
+def bucket_keys(s3):
+    return sorted(item['Key'] for item in s3.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+
+
+def test_uploads_every_file(s3, shards):
+    common.upload_files(s3, shards, BUCKET, common.Uploader(s3, BUCKET, workers=4))
+
+    assert bucket_keys(s3) == ['sqs_scan/queue-{:05d}.ndjson'.format(i + 1) for i in range(6)]
+    head = s3.head_object(Bucket=BUCKET, Key='sqs_scan/queue-00001.ndjson')
+    assert head['Metadata']['sha256'] == common.file_sha256(shards[0])
+    with open(common.MANIFEST_FILE) as f:
+        assert len(json.load(f)[BUCKET]) == 6
+
+
+def test_unchanged_files_are_skipped(s3, shards):
+    common.upload_files(s3, shards, BUCKET)
+    with open(shards[0], 'a') as f:
+        f.write('{"Body": "new message"}\n')
+
+    uploader = common.Uploader(s3, BUCKET)
+    results = dict((file_name, uploader.upload(file_name)) for file_name in shards)
+
+    assert results[shards[0]] == (os.path.getsize(shards[0]), 0)
+    for file_name in shards[1:]:
+        assert results[file_name] == (0, os.path.getsize(file_name))
+
+
+def test_changed_remote_object_is_uploaded_again(s3, shards):
+    common.upload_files(s3, shards, BUCKET)
+    s3.put_object(Bucket=BUCKET, Key='sqs_scan/queue-00001.ndjson', Body=b'replaced')
+
+    uploaded, skipped = common.Uploader(s3, BUCKET).upload(shards[0])
+
+    assert (uploaded, skipped) == (os.path.getsize(shards[0]), 0)
+
+
+def test_failed_upload_keeps_the_manifest(s3, shards, capsys):
+    uploader = common.Uploader(s3, BUCKET)
+    upload = uploader.upload
+
+    def _upload(file_name, sha256=None):
+        if file_name == shards[0]:
+            raise ValueError('connection reset')
+        return upload(file_name, sha256)
+
+    uploader.upload = _upload
+    common.upload_files(s3, shards, BUCKET, uploader)
+
+    assert 'Upload of {} failed: connection reset'.format(shards[0]) in capsys.readouterr().out
+    with open(common.MANIFEST_FILE) as f:
+        assert sorted(json.load(f)[BUCKET]) == ['sqs_scan/queue-{:05d}.ndjson'.format(i + 1) for i in range(1, 6)]